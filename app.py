@@ -1,86 +1,891 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-import google.generativeai as genai
+from google.ai import generativelanguage as glm
+import openpyxl
 import requests
 import urllib.parse
 import json
 import time
+import os
+import io
+import hashlib
+import threading
+import math
+import functools
+import contextlib
+import re
+import unicodedata
+import sqlite3
+import logging
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 st.set_page_config(page_title="ระบบข้อมูลลูกค้า 68", page_icon="🏗️", layout="wide")
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)  # หน้าต่างๆ ได้ view ของชุดข้อมูลที่ใช้ร่วมกัน ไม่ใช่สำเนา
 
-SHEET_URL = "https://docs.google.com/spreadsheets/d/1H-MAlMRfzHhJQfHeCUj3_-smdxJcTmR9K2IvgL0vm8k/export?format=csv&gid=1958455392"
-DBD_API = "https://datawarehouse.dbd.go.th/api/juristic/search"
+SHEET_URL = os.environ.get("SHEET_URL", "https://docs.google.com/spreadsheets/d/1H-MAlMRfzHhJQfHeCUj3_-smdxJcTmR9K2IvgL0vm8k/export?format=csv&gid=1958455392")
+# Sheet รายปี: LUKKA_SHEETS="66=url,67=url,68=url" (ไม่ตั้ง = ใช้ SHEET_URL เป็นปี 68 ปีเดียว) ปีล่าสุดคือข้อมูลหลักของทุกหน้า
+SHEET_SOURCES = {y.strip(): u.strip() for y, u in (item.split('=', 1) for item in os.environ.get("LUKKA_SHEETS", "").split(',') if '=' in item)} or {'68': SHEET_URL}
+CURRENT_YEAR = max(SHEET_SOURCES, key=lambda y: (len(y), y))
+DBD_BASE = os.environ.get("DBD_BASE", "https://datawarehouse.dbd.go.th")
+DBD_API = f"{DBD_BASE}/api/juristic/search"
+DBD_FALLBACK_API = f"{DBD_BASE}/api/companyInfo/search"
+DBD_HEADERS = {'User-Agent': 'Mozilla/5.0', 'Accept': 'application/json', 'Referer': 'https://datawarehouse.dbd.go.th/'}
+DBD_WORKERS = int(os.environ.get("DBD_WORKERS", "4"))
+DBD_RATE = float(os.environ.get("DBD_RATE", "2"))  # คำขอต่อวินาทีต่อ host
+DBD_CACHE_TTL = 7 * 24 * 3600
+REFRESH_SECONDS = int(os.environ.get("LUKKA_REFRESH_SECONDS", "3600"))
+CACHE_DIR = os.environ.get("LUKKA_CACHE_DIR", ".cache")
+DBD_CACHE_PATH = os.path.join(CACHE_DIR, "dbd_cache.sqlite")
+ENRICH_PATH = os.path.join(CACHE_DIR, "dbd_enriched.parquet")
+log = logging.getLogger("lukka")
+METRICS_ENABLED = os.environ.get("LUKKA_METRICS", "1") != "0"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
 
-@st.cache_data(ttl=3600)
-def load_data():
-    df = pd.read_csv(SHEET_URL, header=1)
+class Metrics:
+    """metrics ของทั้ง process: histogram เวลาต่อ span และตัวนับเหตุการณ์ (cache lookup/miss, error)"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.hist = {}
+        self.counters = defaultdict(int)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            h = self.hist.setdefault(name, {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0})
+            h['buckets'][next((i for i, b in enumerate(LATENCY_BUCKETS) if seconds <= b), len(LATENCY_BUCKETS))] += 1
+            h['sum'] += seconds
+            h['count'] += 1
+            h['max'] = max(h['max'], seconds)
+
+    def count(self, name, label='', n=1):
+        with self.lock:
+            self.counters[(name, label)] += n
+
+    @staticmethod
+    def quantile(h, q):
+        """ประมาณ quantile จาก bucket ของ histogram h (คืนขอบบนของ bucket) — ส่งสำเนาที่ได้ภายใต้ lock เข้ามา"""
+        target, seen = q * h['count'], 0
+        for bound, n in zip(LATENCY_BUCKETS + (h['max'],), h['buckets']):
+            seen += n
+            if seen >= target:
+                return min(bound, h['max'])
+        return h['max']
+
+    def snapshot(self):
+        with self.lock:
+            hist = {k: dict(v, buckets=list(v['buckets'])) for k, v in self.hist.items()}
+            counters = dict(self.counters)
+        spans = {k: dict(v, mean=v['sum'] / v['count'], p50=self.quantile(v, 0.5), p95=self.quantile(v, 0.95)) for k, v in hist.items()}
+        lookups = {label: n for (name, label), n in counters.items() if name == 'cache_lookups'}
+        hit_rate = {label: 1 - counters.get(('cache_misses', label), 0) / n for label, n in lookups.items() if n}
+        return {'uptime': time.time() - self.started, 'bucket_bounds': list(LATENCY_BUCKETS), 'spans': spans, 'cache_hit_rate': hit_rate,
+                'counters': [{'name': name, 'label': label, 'value': n} for (name, label), n in sorted(counters.items())]}
+
+    def prometheus(self):
+        """ข้อความรูปแบบ Prometheus exposition"""
+        snap = self.snapshot()
+        out = ['# TYPE lukka_span_seconds histogram']
+        for name, h in snap['spans'].items():
+            cum = 0
+            for bound, n in zip([*map(str, LATENCY_BUCKETS), '+Inf'], h['buckets']):
+                cum += n
+                out.append(f'lukka_span_seconds_bucket{{span="{name}",le="{bound}"}} {cum}')
+            out.append(f'lukka_span_seconds_sum{{span="{name}"}} {h["sum"]}')
+            out.append(f'lukka_span_seconds_count{{span="{name}"}} {h["count"]}')
+        out.append('# TYPE lukka_events_total counter')
+        out += [f'lukka_events_total{{name="{c["name"]}",label="{c["label"]}"}} {c["value"]}' for c in snap['counters']]
+        return '\n'.join(out) + '\n'
+
+@st.cache_resource
+def metrics():
+    return Metrics()
+
+class Span:
+    """จับเวลา block ของโค้ดลง histogram และนับ error ถ้ามี exception หลุดออกมา"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        m = metrics()
+        m.observe(self.name, time.perf_counter() - self.t0)
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            m.count('errors', self.name)
+
+_NO_SPAN = contextlib.nullcontext()
+
+def span(name):
+    return Span(name) if METRICS_ENABLED else _NO_SPAN
+
+def count(name, label='', n=1):
+    if METRICS_ENABLED:
+        metrics().count(name, label, n)
+
+def tracked(name, cache):
+    """ห่อฟังก์ชันด้วย st.cache_* พร้อมนับ lookup/miss (ไว้คำนวณ hit rate) และจับเวลาตอนคำนวณจริง"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def miss(*args, **kwargs):
+            count('cache_misses', name)
+            with span(f'build:{name}'):
+                return fn(*args, **kwargs)
+        cached = cache(miss)
+        @functools.wraps(fn)
+        def lookup(*args, **kwargs):
+            count('cache_lookups', name)
+            return cached(*args, **kwargs)
+        lookup.clear = cached.clear
+        return lookup
+    return decorate
+INGEST_CHUNK_ROWS = int(os.environ.get("LUKKA_CHUNK_ROWS", "50000"))
+COLUMN_NAMES = ['ลำดับ','บจก','หจก','บมจ','JV','บริษัท','ปีจดทะเบียน','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','pct1','pct2','pct3','pct4','รวมคะแนน','เกรด']
+NUMERIC_COLS = ['ลำดับ','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน','ปีจดทะเบียน']
+# อ่านทุกคอลัมน์ดิบเป็นข้อความ แล้วให้ clean_chunk แปลงตัวเลขเอง — dtype ของแต่ละ chunk จึงไม่ขึ้นกับเซลล์อื่น
+# (ข้อความเซลล์เดียวในคอลัมน์ตัวเลขจะไม่เปลี่ยน dtype/hash ของทั้ง chunk และไม่ทำให้ chunk ต่อกันไม่ได้)
+RAW_DTYPES = {i: str for i in range(len(COLUMN_NAMES))}
+# (คอลัมน์ธง, ค่าที่นับว่าใช่, ประเภท) — ลำดับสำคัญ ตรงกับลำดับการตรวจเดิม
+TYPE_FLAGS = [('บจก',['บจก.','บจก'],'บจก.'),('หจก',['หจก.','หจก'],'หจก.'),('บมจ',['บมจ.','บมจ'],'บมจ.'),('JV',['JV'],'JV')]
+TYPE_ORDER = [t for *_, t in TYPE_FLAGS] + ['อื่นๆ']
+GRADE_ORDER = ['A++','A+','A','B+','B','C+','C','D','F']  # สูง → ต่ำ
+# คอลัมน์ที่หน้าต่างๆ ใช้จริง — คอลัมน์ธงประเภทและ pct1-4 ตัดทิ้งหลังจัดประเภทแล้ว
+KEEP_COLS = ['ลำดับ','บริษัท','ประเภท','ปีจดทะเบียน','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน','เกรด']
+
+def fetch_sheet(url, etag=None):
+    """ดึง CSV ต้นทาง (URL หรือไฟล์ในเครื่อง) คืน (bytes, etag) — bytes เป็น None ถ้าไม่เปลี่ยน (304)"""
+    if not url.startswith(('http://','https://')):
+        with open(url.removeprefix('file://'), 'rb') as f:
+            return f.read(), None
+    headers = {'If-None-Match': etag} if etag else {}
+    resp = requests.get(url, headers=headers, timeout=30)
+    if resp.status_code == 304:
+        return None, etag
+    resp.raise_for_status()
+    return resp.content, resp.headers.get('ETag')
+
+def clean_chunk(df):
+    """ทำความสะอาดข้อมูลแบบ vectorized: กรองแถวครั้งเดียว แปลงตัวเลข และจัดประเภทจากคอลัมน์ธง"""
     cols = list(df.columns)
-    names = ['ลำดับ','บจก','หจก','บมจ','JV','บริษัท','ปีจดทะเบียน','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','pct1','pct2','pct3','pct4','รวมคะแนน','เกรด']
-    rename = {cols[i]: names[i] for i in range(min(len(cols), len(names)))}
-    df = df.rename(columns=rename)
-    df = df.dropna(subset=['บริษัท'])
-    df['บริษัท'] = df['บริษัท'].astype(str).str.strip()
-    df = df[df['บริษัท'].str.len() > 2]
-    df = df[~df['บริษัท'].isin(['nan','None','บริษัท'])]
-    for col in ['ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน']:
+    df = df.rename(columns={cols[i]: COLUMN_NAMES[i] for i in range(min(len(cols), len(COLUMN_NAMES)))})
+    name = df['บริษัท'].astype(str).str.strip()
+    keep = df['บริษัท'].notna() & (name.str.len() > 2) & ~name.isin(['nan','None','บริษัท'])
+    df = df.loc[keep]
+    new = {'บริษัท': name[keep]}
+    for col in NUMERIC_COLS:
         if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    df['ปีจดทะเบียน'] = pd.to_numeric(df['ปีจดทะเบียน'], errors='coerce')
-    def get_type(row):
-        if str(row.get('บจก','')).strip() in ['บจก.','บจก']: return 'บจก.'
-        if str(row.get('หจก','')).strip() in ['หจก.','หจก']: return 'หจก.'
-        if str(row.get('บมจ','')).strip() in ['บมจ.','บมจ']: return 'บมจ.'
-        if str(row.get('JV','')).strip() == 'JV': return 'JV'
-        return 'อื่นๆ'
-    df['ประเภท'] = df.apply(get_type, axis=1)
-    return df
+            new[col] = pd.to_numeric(df[col], errors='coerce').astype(np.float64)
+    conds = [df[col].astype(str).str.strip().isin(vals) if col in df.columns else np.zeros(len(df), dtype=bool) for col, vals, _ in TYPE_FLAGS]
+    new['ประเภท'] = pd.Series(np.select(conds, [t for *_, t in TYPE_FLAGS], 'อื่นๆ'), index=df.index)
+    return df.assign(**new)
 
-def search_dbd(company_name):
-    """ค้นหาบริษัทจาก DBD Open Data API"""
+def parse_sheet(raw, prev=None):
+    """แปลง CSV ดิบเป็น DataFrame ที่ทำความสะอาดและย่อขนาดแล้ว พร้อมคอลัมน์ _hash ของแถวดิบ คืน (df, stats)
+    อ่านทีละ INGEST_CHUNK_ROWS แถว — ถ้ามี prev (snapshot เดิม) แถวที่ hash ไม่เปลี่ยนจะใช้ผลเดิมโดยไม่ทำความสะอาดซ้ำ"""
+    known = prev.drop_duplicates('_hash').set_index('_hash') if prev is not None and '_hash' in prev.columns else None
+    parts, stats = [], {'rows_reused': 0, 'rows_parsed': 0, 'memory_before': 0}
+    for chunk in pd.read_csv(io.BytesIO(raw), header=1, dtype=RAW_DTYPES, chunksize=INGEST_CHUNK_ROWS):
+        h = pd.Series(pd.util.hash_pandas_object(chunk, index=False).to_numpy(), index=chunk.index)
+        if known is not None:
+            seen = h.isin(known.index)
+            if seen.any():
+                parts.append(known.loc[h[seen]].set_axis(h.index[seen]).assign(_hash=h[seen]))
+                stats['rows_reused'] += int(seen.sum())
+                chunk, h = chunk[~seen], h[~seen]
+        if len(chunk):
+            cleaned = clean_chunk(chunk)
+            stats['rows_parsed'] += len(chunk)
+            stats['memory_before'] += int(cleaned.memory_usage(deep=True).sum())
+            if len(cleaned):  # แถวที่ถูกกรองทิ้งหมด (เช่นแถวว่างท้าย Sheet) ต้องไม่กลายเป็นแถว NaN ตอน assign
+                parts.append(compact_frame(cleaned).assign(_hash=h.loc[cleaned.index]))
+    if not parts:
+        parts = [compact_frame(clean_chunk(pd.read_csv(io.BytesIO(raw), header=1, dtype=RAW_DTYPES))).assign(_hash=np.uint64(0))]
+    return compact_frame(pd.concat(parts).sort_index()), stats
+
+def ordered_categorical(s, order):
+    """ordered categorical เรียงต่ำ → สูง ตาม order (สูง → ต่ำ) ค่าที่ไม่รู้จักถือว่าต่ำสุด"""
+    present = set(s.dropna().unique())
+    known = [v for v in order if v in present]
+    return pd.Categorical(s, categories=sorted(present - set(order)) + known[::-1], ordered=True)
+
+def compact_frame(df):
+    """ลดขนาดข้อมูลตาม schema: เก็บเฉพาะ KEEP_COLS, ประเภท/เกรดเป็น ordered categorical,
+    ปีเป็น Int16, คะแนนเป็น float32, ชื่อเป็น Arrow string — เรียกซ้ำกับข้อมูลที่ย่อแล้วได้"""
+    df = df[[c for c in KEEP_COLS + ['_hash'] if c in df.columns]]
+    new = {}
+    for col, order in [('ประเภท', TYPE_ORDER), ('เกรด', GRADE_ORDER)]:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            new[col] = ordered_categorical(df[col], order)
+    for col, dtype in [('ลำดับ','Int32'), ('ปีจดทะเบียน','Int16')]:
+        if col in df.columns and pd.api.types.is_float_dtype(df[col]):
+            v = df[col]
+            if ((v % 1 == 0) | v.isna()).all():
+                new[col] = v.where(v.abs() <= np.iinfo(dtype.lower()).max).astype(dtype)
+    if 'รวมคะแนน' in df.columns and df['รวมคะแนน'].dtype == np.float64:
+        new['รวมคะแนน'] = df['รวมคะแนน'].astype(np.float32)
+    if df['บริษัท'].dtype == object:
+        new['บริษัท'] = df['บริษัท'].astype(pd.StringDtype('pyarrow'))
+    return df.assign(**new)
+
+def snapshot_path(year, ext):
+    return os.path.join(CACHE_DIR, f"snapshot_{year}.{ext}")
+
+def read_meta(year):
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0',
-            'Accept': 'application/json',
-            'Referer': 'https://datawarehouse.dbd.go.th/'
-        }
-        # ลอง DBD search API
-        params = {'keyword': company_name, 'limit': 10}
-        resp = requests.get(DBD_API, params=params, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            data = resp.json()
-            return data
-    except Exception as e:
-        pass
-    
-    # Fallback: ลอง open API อีกตัว
+        with open(snapshot_path(year, 'json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_meta(year, meta):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = snapshot_path(year, 'json.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp, snapshot_path(year, 'json'))
+
+def read_snapshot(year):
+    """อ่าน snapshot ล่าสุดของปี (Parquet, memory-mapped) คืน (df, meta) หรือ (None, meta) ถ้ายังไม่มี"""
+    meta = read_meta(year)
     try:
-        url = f"https://datawarehouse.dbd.go.th/api/companyInfo/search?name={urllib.parse.quote(company_name)}"
-        resp = requests.get(url, headers=headers, timeout=10)
-        if resp.status_code == 200:
-            return resp.json()
-    except:
-        pass
-    
+        return pd.read_parquet(snapshot_path(year, 'parquet'), memory_map=True), meta
+    except (OSError, ValueError):
+        return None, meta
+
+def refresh_snapshot(year):
+    """ตรวจ Sheet ต้นทางของปี แปลงใหม่เฉพาะเมื่อ ETag หรือ hash ทั้งไฟล์เปลี่ยน และทำความสะอาดใหม่เฉพาะแถวที่เปลี่ยน
+    คืน True ถ้า snapshot ถูกเขียนใหม่ ผู้เรียกต้องไม่เรียกซ้อนกัน (DatasetStore ถือ lock ไว้)"""
+    meta = read_meta(year)
+    path = snapshot_path(year, 'parquet')
+    have_snap = os.path.exists(path)
+    try:
+        with span('sheet_fetch'):
+            raw, etag = fetch_sheet(SHEET_SOURCES[year], meta.get('etag') if have_snap else None)
+    except Exception as e:
+        meta.update(error=str(e), error_at=time.time())
+        write_meta(year, meta)
+        raise
+    meta.update(checked_at=time.time(), error=None)
+    count('cache_lookups', 'snapshot')
+    if raw is None:
+        write_meta(year, meta)
+        return False
+    sha = hashlib.sha256(raw).hexdigest()
+    meta['etag'] = etag
+    if have_snap and sha == meta.get('sha256'):
+        write_meta(year, meta)
+        return False
+    count('cache_misses', 'snapshot')
+    with span('sheet_parse'):
+        df, stats = parse_sheet(raw, read_snapshot(year)[0] if have_snap else None)
+    count('rows_reused', year, stats['rows_reused'])
+    count('rows_parsed', year, stats['rows_parsed'])
+    after = int(df.drop(columns='_hash').memory_usage(deep=True).sum())
+    log.info("ปี %s: %d แถว (ใช้ผลเดิม %d, ทำความสะอาดใหม่ %d) %.1f MB", year, len(df), stats['rows_reused'], stats['rows_parsed'], after / 2**20)
+    if not stats['rows_reused']:
+        meta.update(memory_before=stats['memory_before'], memory_after=after)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = path + '.tmp'
+    df.to_parquet(tmp)
+    os.replace(tmp, path)
+    meta.update(sha256=sha, fetched_at=meta['checked_at'], rows=len(df), rows_reused=stats['rows_reused'])
+    write_meta(year, meta)
+    return True
+
+def load_data(year=CURRENT_YEAR):
+    """อ่าน snapshot ของปี (ถ้ายังไม่มีจะดึงจากต้นทางก่อน) แล้วเติมผล DBD คืน (df, meta)
+    meta['version'] ใช้เป็น key ของ cache ปลายทาง (ดัชนีค้นหา, ผลสรุป) เปลี่ยนเมื่อข้อมูลหรือผลเติม DBD เปลี่ยน"""
+    with span('load_data'):
+        df, meta = read_snapshot(year)
+        if df is None:
+            refresh_snapshot(year)
+            df, meta = read_snapshot(year)
+        return apply_enrichment(compact_frame(df).drop(columns='_hash', errors='ignore'), meta)
+
+class DatasetStore:
+    """ชุดข้อมูลที่ทุก session ใช้ร่วมกัน (ห้ามแก้ไข df ที่ได้จาก get()) — ทุกปีใน SHEET_SOURCES และผลเทียบรายปี
+    thread เบื้องหลังตรวจต้นทางทุก REFRESH_SECONDS แล้วสลับชุดใหม่เข้ามาแบบ atomic"""
+    def __init__(self, sources, interval):
+        self.sources = sources
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.years = {}
+        self.history = {}
+        threading.Thread(target=self.run, name='dataset-refresher', daemon=True).start()
+
+    def get(self):
+        """คืน (df, meta) ของปีหลัก — ครั้งแรกโหลดจาก snapshot ทันทีแล้วให้ thread เบื้องหลังตรวจต้นทางต่อ"""
+        years = self.years
+        if CURRENT_YEAR not in years:
+            with self.lock:
+                if CURRENT_YEAR not in self.years:
+                    self.load(self.sources)
+                    self.wake.set()
+                years = self.years
+        return years[CURRENT_YEAR]
+
+    def load(self, which):
+        """โหลดปีที่ระบุจาก snapshot แล้วสลับ dict ของทุกปีและผลเทียบรายปีชุดใหม่เข้ามา (ต้องถือ lock)"""
+        years = dict(self.years)
+        for year in which:
+            try:
+                years[year] = load_data(year)
+            except Exception as e:
+                if year == CURRENT_YEAR:
+                    raise
+                log.warning("โหลดข้อมูลปี %s ไม่ได้: %s", year, e)
+        self.history = build_history(years)
+        self.years = years
+
+    def reload(self):
+        """อ่าน snapshot + ผล DBD ใหม่ทุกปีแล้วสลับเข้ามา (ไม่ยิงต้นทาง)"""
+        with self.lock:
+            self.load(self.sources)
+
+    def refresh(self):
+        """ตรวจต้นทางทุกปีหนึ่งครั้ง ถ้ามี refresh อื่นทำอยู่จะรอผลของรอบนั้นแทนการยิงซ้ำ คืน True ถ้าข้อมูลเปลี่ยน"""
+        if not self.lock.acquire(blocking=False):
+            with self.lock:
+                return False
+        try:
+            changed, errors = [], {}
+            for year in self.sources:
+                try:
+                    if refresh_snapshot(year):
+                        changed.append(year)
+                except Exception as e:
+                    log.warning("รีเฟรชข้อมูลปี %s จากต้นทางไม่สำเร็จ ใช้ snapshot เดิม: %s", year, e)
+                    errors[year] = str(e)
+            if changed or CURRENT_YEAR not in self.years:
+                self.load(changed or self.sources)
+            years = dict(self.years)
+            for year, (df, meta) in years.items():
+                if meta.get('error') != errors.get(year):
+                    years[year] = (df, dict(meta, error=errors.get(year)))
+            self.years = years
+            return bool(changed)
+        except Exception as e:
+            log.warning("รีเฟรชข้อมูลไม่สำเร็จ: %s", e)
+            return False
+        finally:
+            self.lock.release()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.refresh()
+
+@st.cache_resource
+def dataset_store():
+    return DatasetStore(SHEET_SOURCES, REFRESH_SECONDS)
+
+class RateLimiter:
+    """จำกัดอัตราคำขอต่อ host ใช้ร่วมกันทุก thread"""
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second
+        self.lock = threading.Lock()
+        self.next_at = defaultdict(float)
+
+    def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at[host])
+            self.next_at[host] = at + self.interval
+        time.sleep(at - now)
+
+class DbdCache:
+    """cache ผลตอบกลับ DBD บนดิสก์ (SQLite) พร้อมอายุ TTL — ค้นซ้ำไม่ต้องยิง API"""
+    def __init__(self, path, ttl):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute('CREATE TABLE IF NOT EXISTS dbd (name TEXT PRIMARY KEY, fetched_at REAL, body TEXT)')
+
+    def get(self, name):
+        """คืน (พบใน cache, ข้อมูล)"""
+        with self.lock:
+            row = self.con.execute('SELECT fetched_at, body FROM dbd WHERE name = ?', (name,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl:
+            return False, None
+        return True, json.loads(row[1])
+
+    def put(self, name, data):
+        with self.lock, self.con:
+            self.con.execute('INSERT OR REPLACE INTO dbd VALUES (?, ?, ?)', (name, time.time(), json.dumps(data, ensure_ascii=False)))
+
+@st.cache_resource
+def dbd_session():
+    """keep-alive session ที่มี connection pool และ retry แบบ backoff (429/5xx)"""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429,500,502,503,504], allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=DBD_WORKERS, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(DBD_HEADERS)
+    return session
+
+@st.cache_resource
+def dbd_rate_limiter():
+    return RateLimiter(DBD_RATE)
+
+@st.cache_resource
+def dbd_cache():
+    return DbdCache(DBD_CACHE_PATH, DBD_CACHE_TTL)
+
+def search_dbd(company_name):
+    """ค้นหาบริษัทจาก DBD Open Data API (ใช้ cache บนดิสก์ก่อน แล้วจึงลอง API หลักและ API สำรอง)"""
+    hit, data = dbd_cache().get(company_name)
+    count('cache_lookups', 'dbd')
+    if hit:
+        return data
+    count('cache_misses', 'dbd')
+    for url, params in [(DBD_API, {'keyword': company_name, 'limit': 10}), (DBD_FALLBACK_API, {'name': company_name})]:
+        try:
+            dbd_rate_limiter().wait(url)
+            with span('dbd_request'):
+                resp = dbd_session().get(url, params=params, timeout=10)
+            if resp.status_code == 200:
+                data = resp.json()
+                dbd_cache().put(company_name, data)
+                return data
+            count('errors', f'dbd_http_{resp.status_code}')
+            log.warning("DBD %s ตอบกลับ %s สำหรับ %r", url, resp.status_code, company_name)
+        except (requests.RequestException, ValueError) as e:
+            count('errors', 'dbd_request')
+            log.warning("DBD %s ผิดพลาดสำหรับ %r: %s", url, company_name, e)
     return None
 
+def dbd_items(result):
+    """ดึงรายการนิติบุคคลออกจากผลตอบกลับ DBD (รูปแบบ JSON ต่างกันตาม endpoint)"""
+    if isinstance(result, dict):
+        return result.get('data', result.get('result', result.get('items', []))) or []
+    return result if isinstance(result, list) else []
+
+def dbd_row(item):
+    return {
+        'ชื่อบริษัท': item.get('juristicName', item.get('name', item.get('companyName', ''))),
+        'เลขทะเบียน': item.get('juristicId', item.get('registrationNumber', item.get('id', ''))),
+        'ประเภท': item.get('juristicType', item.get('type', '')),
+        'ทุนจดทะเบียน': item.get('registerCapital', item.get('capital', '')),
+        'วันจดทะเบียน': item.get('registerDate', item.get('registrationDate', '')),
+        'สถานะ': item.get('statusCode', item.get('status', '')),
+    }
+
+def dbd_facts(result, name):
+    """ทุนจดทะเบียน (ล้านบาท) และปีจดทะเบียน (พ.ศ.) ของรายการที่ชื่อตรงกับ name (เทียบด้วย company_key) หรือ None
+    ผลค้นหาแบบคำค้นอาจคืนบริษัทอื่นมาก่อน จึงไม่ใช้รายการแรกโดยไม่ตรวจชื่อ"""
+    key = company_key(name)
+    row = next((r for r in map(dbd_row, dbd_items(result)) if company_key(r['ชื่อบริษัท']) == key), None)
+    if row is None:
+        return None
+    capital = pd.to_numeric(str(row['ทุนจดทะเบียน']).replace(',', ''), errors='coerce')
+    year = re.search(r'\d{4}', str(row['วันจดทะเบียน']))
+    year = int(year.group()) if year else None
+    if year and year < 2400:
+        year += 543
+    if pd.isna(capital) and year is None:
+        return None
+    return {'ทุนจดทะเบียน': capital / 1e6 if pd.notna(capital) else None, 'ปีจดทะเบียน': year}
+
+def enrich_dbd(names, progress=None, workers=DBD_WORKERS):
+    """ค้นหา DBD ของหลายบริษัทพร้อมกันด้วย thread pool คืน DataFrame(บริษัท, ทุนจดทะเบียน, ปีจดทะเบียน)
+    progress(done, total) ถูกเรียกจาก thread ที่เรียกฟังก์ชันนี้ ใช้อัปเดต st.progress ได้
+    ถ้าถูกขัดจังหวะ (ผู้ใช้กดอย่างอื่นระหว่างทำงาน → rerun) จะยกเลิกคำค้นที่ยังไม่เริ่มทันทีแทนการรอให้ครบ
+    ผลที่ค้นเสร็จแล้วยังอยู่ใน DbdCache การสั่งงานซ้ำจึงไม่ยิง DBD ซ้ำ"""
+    rows = []
+    ctx = get_script_run_ctx()
+    ex = ThreadPoolExecutor(max_workers=workers, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+    try:
+        futs = {ex.submit(search_dbd, n): n for n in names}
+        for done, fut in enumerate(as_completed(futs), 1):
+            facts = dbd_facts(fut.result(), futs[fut])
+            if facts:
+                rows.append({'บริษัท': futs[fut], **facts})
+            if progress:
+                progress(done, len(futs))
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+    return pd.DataFrame(rows, columns=['บริษัท','ทุนจดทะเบียน','ปีจดทะเบียน'])
+
+def save_enrichment(found):
+    """รวมผลค้นหา DBD ใหม่เข้ากับที่บันทึกไว้ (ผลใหม่ทับผลเก่า)"""
+    if os.path.exists(ENRICH_PATH):
+        found = pd.concat([pd.read_parquet(ENRICH_PATH), found])
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = ENRICH_PATH + '.tmp'
+    found.drop_duplicates('บริษัท', keep='last').reset_index(drop=True).to_parquet(tmp)
+    os.replace(tmp, ENRICH_PATH)
+
+def apply_enrichment(df, meta):
+    """เติมทุน/ปีจดทะเบียนที่ขาดจากผล DBD ที่บันทึกไว้ และกำหนด meta['version']"""
+    meta = dict(meta, version=meta.get('sha256'))
+    if not os.path.exists(ENRICH_PATH):
+        return df, meta
+    enr = pd.read_parquet(ENRICH_PATH).set_index('บริษัท')
+    for col in ['ทุนจดทะเบียน','ปีจดทะเบียน']:
+        fill = df['บริษัท'].map(enr[col]).astype(float)
+        gap = df[col].isna() | (df[col] == 0)
+        df[col] = df[col].mask(gap & fill.notna(), fill.round().astype(df[col].dtype) if df[col].dtype == 'Int16' else fill)
+    meta['version'] = f"{meta.get('sha256')}:{os.stat(ENRICH_PATH).st_mtime_ns}"
+    return df, meta
+
 def get_dbd_link(company_name):
     """สร้าง URL ค้นหาตรงใน DBD Datawarehouse"""
     encoded = urllib.parse.quote(company_name)
     return f"https://datawarehouse.dbd.go.th/searchJuristic?juristicName={encoded}"
 
+NGRAM = 3
+FUZZY_MIN = 0.5  # สัดส่วน n-gram ของคำค้นที่ต้องตรง จึงนับเป็นผลลัพธ์แบบใกล้เคียง
+_PUNCT = re.compile(r"[\s\-.,()'\"/&_+]+")
+
+def normalize_name(text):
+    """ทำชื่อให้อยู่ในรูปเดียวกัน: NFKC, ตัวพิมพ์เล็ก, ตัดช่องว่างและเครื่องหมาย (ซิโน-ไทย → ซิโนไทย)"""
+    return _PUNCT.sub('', unicodedata.normalize('NFKC', str(text)).casefold())
+
+def ngrams(text):
+    return {text[i:i+NGRAM] for i in range(max(len(text) - NGRAM + 1, 1))}
+
+# คำบอกรูปแบบนิติบุคคลที่ตัดออกก่อนจับคู่บริษัทข้ามปี (ยาวก่อนสั้น)
+LEGAL_WORDS = [normalize_name(w) for w in ['ห้างหุ้นส่วนจำกัด','ห้างหุ้นส่วนสามัญ','บริษัท','จำกัด','(มหาชน)','มหาชน','บจก.','หจก.','บมจ.',
+                                           'Public Company Limited','Company Limited','Co., Ltd.','Ltd.','Limited']]
+
+def company_key(name):
+    """key ตัวตนบริษัทสำหรับจับคู่ข้ามปี: ชื่อที่ normalize แล้วและตัดคำบอกรูปแบบนิติบุคคล"""
+    key = normalize_name(name)
+    for w in LEGAL_WORDS:
+        key = key.replace(w, '')
+    return key or normalize_name(name)
+
+def build_panel(years):
+    """ตารางรวมทุกปี index ด้วย (key, ปี) — บริษัทที่ชื่อซ้ำในปีเดียวกันเก็บแถวรายได้สูงสุด"""
+    frames = []
+    for year, (df, _) in years.items():
+        f = pd.DataFrame({'key': df['บริษัท'].map(company_key), 'ปี': year, 'บริษัท': df['บริษัท'], 'ประเภท': df['ประเภท'].astype(object),
+                          'รายได้รวม': df['รายได้รวม'], 'เกรด': df['เกรด'].astype(object) if 'เกรด' in df.columns else None})
+        frames.append(f.sort_values('รายได้รวม', ascending=False, na_position='last').drop_duplicates('key'))
+    return pd.concat(frames).set_index(['key','ปี']).sort_index()
+
+def compare_years(panel, prev, cur):
+    """เทียบสองปีด้วยการ join บน key: รายได้/เกรดที่เปลี่ยน และสถานะ ต่อเนื่อง / ลูกค้าใหม่ / หายไป"""
+    a, b = panel.xs(prev, level='ปี'), panel.xs(cur, level='ปี')
+    j = a.join(b, how='outer', lsuffix=f' {prev}', rsuffix=f' {cur}')
+    in_a, in_b = j.index.isin(a.index), j.index.isin(b.index)
+    j.insert(0, 'สถานะ', np.select([in_a & in_b, in_b], ['ต่อเนื่อง','ลูกค้าใหม่'], 'หายไป'))
+    j.insert(1, 'บริษัท', j[f'บริษัท {cur}'].fillna(j[f'บริษัท {prev}']))
+    j['รายได้เปลี่ยน'] = j[f'รายได้รวม {cur}'] - j[f'รายได้รวม {prev}']
+    j['รายได้เปลี่ยน %'] = (j['รายได้เปลี่ยน'] / j[f'รายได้รวม {prev}'].where(j[f'รายได้รวม {prev}'] > 0) * 100).round(1)
+    rank = {g: i for i, g in enumerate(GRADE_ORDER[::-1])}
+    ga, gb = j[f'เกรด {prev}'].map(rank), j[f'เกรด {cur}'].map(rank)
+    j['เกรดเปลี่ยน'] = np.select([gb > ga, gb < ga, gb == ga], ['ขึ้น','ลง','คงเดิม'], '')
+    return j.drop(columns=[f'บริษัท {prev}', f'บริษัท {cur}']).reset_index(drop=True)
+
+def build_history(years):
+    """ผลเทียบทุกคู่ปีที่ติดกัน คำนวณครั้งเดียวต่อการรีเฟรช คืน {(ปีก่อน, ปีหลัง): DataFrame}"""
+    if len(years) < 2:
+        return {}
+    with span('build:history'):
+        panel = build_panel(years)
+        order = sorted(years, key=lambda y: (len(y), y))
+        return {(p, c): compare_years(panel, p, c) for p, c in zip(order, order[1:])}
+
+class SearchIndex:
+    """ดัชนีค้นหาลูกค้า สร้างครั้งเดียวต่อเวอร์ชันข้อมูล
+    - postings ของ n-gram ชื่อบริษัท สำหรับค้นหาแบบจัดอันดับ/ทนคำพิมพ์ผิด
+    - bitmap ของประเภท/เกรด และลำดับที่เรียงแล้วของรายได้/ทุน สำหรับตัวกรอง"""
+    def __init__(self, df):
+        self.size = len(df)
+        self.names = [normalize_name(n) for n in df['บริษัท']]
+        postings = defaultdict(list)
+        self.gram_counts = np.zeros(self.size, dtype=np.int32)
+        for i, n in enumerate(self.names):
+            grams = ngrams(n)
+            self.gram_counts[i] = len(grams)
+            for g in grams:
+                postings[g].append(i)
+        self.postings = {g: np.array(v, dtype=np.int32) for g, v in postings.items()}
+        self.bitmaps = {col: {v: (df[col] == v).to_numpy(dtype=bool) for v in df[col].dropna().unique()} for col in ['ประเภท','เกรด'] if col in df.columns}
+        self.sorted = {}
+        for col in ['รายได้รวม','ทุนจดทะเบียน']:
+            if col in df.columns:
+                vals = df[col].to_numpy(dtype=float)
+                order = np.argsort(vals, kind='stable')  # NaN อยู่ท้ายสุด
+                self.sorted[col] = (order, vals[order][:np.count_nonzero(~np.isnan(vals))])
+
+    def any_of(self, col, values):
+        mask = np.zeros(self.size, dtype=bool)
+        for v in values:
+            if v in self.bitmaps.get(col, {}):
+                mask |= self.bitmaps[col][v]
+        return mask
+
+    def at_least(self, col, minimum):
+        order, vals = self.sorted[col]
+        mask = np.zeros(self.size, dtype=bool)
+        mask[order[np.searchsorted(vals, minimum, side='left'):len(vals)]] = True
+        return mask
+
+    def filter_mask(self, types=None, grades=None, min_revenue=0, min_capital=0):
+        """รวมตัวกรองเป็น bitmap เดียว (ค่าว่าง/0 = ไม่กรอง เหมือนหน้าค้นหาเดิม)"""
+        mask = np.ones(self.size, dtype=bool)
+        if types: mask &= self.any_of('ประเภท', types)
+        if grades: mask &= self.any_of('เกรด', grades)
+        if min_revenue > 0: mask &= self.at_least('รายได้รวม', min_revenue)
+        if min_capital > 0: mask &= self.at_least('ทุนจดทะเบียน', min_capital)
+        return mask
+
+    def search(self, query, mask=None, fuzzy=True):
+        """คืนตำแหน่งแถว (iloc) ที่ตรงกับคำค้น เรียงตาม: ตรงทั้งคำ > ขึ้นต้นด้วยคำค้น > คะแนน n-gram"""
+        q = normalize_name(query)
+        cand = np.flatnonzero(mask) if mask is not None else np.arange(self.size)
+        if not q:
+            return cand
+        if len(q) < NGRAM:
+            hits = np.array([i for i in cand if q in self.names[i]], dtype=np.int64)
+            return hits[np.argsort([not self.names[i].startswith(q) for i in hits], kind='stable')]
+        grams = ngrams(q)
+        found = [self.postings[g] for g in grams if g in self.postings]
+        if not found:
+            return np.array([], dtype=np.int64)
+        score = np.bincount(np.concatenate(found), minlength=self.size) / len(grams)
+        cand = cand[score[cand] >= (FUZZY_MIN if fuzzy else 1.0)]
+        exact = np.array([q in self.names[i] for i in cand], dtype=bool)
+        if not fuzzy:
+            cand, exact = cand[exact], exact[exact]
+        prefix = np.array([self.names[i].startswith(q) for i in cand], dtype=bool)
+        return cand[np.lexsort((-score[cand], ~prefix, ~exact))]
+
+    def mentioned(self, text, min_score=0.8, limit=10):
+        """ตำแหน่งแถวของบริษัทที่ชื่อปรากฏอยู่ในข้อความ (เช่นคำถามที่พิมพ์ติดกันแบบภาษาไทย) เรียงตามความครบของชื่อ"""
+        grams = [self.postings[g] for g in ngrams(normalize_name(text)) if g in self.postings]
+        if not grams:
+            return np.array([], dtype=np.int64)
+        score = np.bincount(np.concatenate(grams), minlength=self.size) / np.maximum(self.gram_counts, 1)
+        hits = np.flatnonzero(score >= min_score)
+        return hits[np.argsort(-score[hits], kind='stable')][:limit]
+
+@tracked('search_index', st.cache_resource(max_entries=2))
+def get_search_index(version, _df):
+    return SearchIndex(_df)
+
+ERA_BINS = [2499,2519,2539,2559,2570]
+ERA_LABELS = ['ก่อน 2520','2520-2539','2540-2559','2560+']
+
+def group_summary(df, by, **aggs):
+    # ส่ง agg ผ่าน dict: ชื่อคอลัมน์ไทยที่มีสระอำถ้าใช้เป็น keyword ตรงๆ Python จะ normalize (NFKC) เป็นอักขระอื่น
+    return df.groupby(by, observed=True).agg(**aggs).round(1).reset_index()
+
+def compute_aggregates(df):
+    """สรุปทุกตัวเลข/ตารางที่ Dashboard, สรุปกลุ่ม และ AI Chat ใช้ คำนวณครั้งเดียวต่อเวอร์ชันข้อมูล"""
+    has_grade = 'เกรด' in df.columns
+    agg = {
+        'count': len(df),
+        'revenue_sum': df['รายได้รวม'].sum(),
+        'revenue_mean': df['รายได้รวม'].mean(),
+        'capital_mean': df['ทุนจดทะเบียน'].mean(),
+        'year_mean': df['ปีจดทะเบียน'].mean(),
+        'grade_col': 'เกรด' if has_grade else 'ประเภท',
+    }
+    tc = df['ประเภท'].value_counts()
+    agg['type_counts'] = tc[tc > 0].rename_axis('ประเภท').reset_index(name='จำนวน')
+    gc = df['เกรด'].value_counts(sort=False) if has_grade else None
+    agg['grade_counts'] = gc[gc > 0].iloc[::-1].rename_axis('เกรด').reset_index(name='จำนวน') if has_grade else None
+    agg['a_plus_plus'] = int((df['เกรด'] == 'A++').sum()) if has_grade else None
+    top = df.nlargest(10, 'รายได้รวม')
+    agg['top10'] = pd.DataFrame({'บริษัท': top['บริษัท'].str[:22], 'รายได้รวม': top['รายได้รวม']})
+    agg['top5'] = top.head(5)[['บริษัท','รายได้รวม',agg['grade_col']]].reset_index(drop=True)
+    agg['year_counts'] = df.groupby('ปีจดทะเบียน').size().reset_index(name='จำนวน').dropna()
+    agg['by_type'] = group_summary(df, 'ประเภท', **{'จำนวน': ('บริษัท','count'), 'รายได้รวม': ('รายได้รวม','sum'), 'รายได้เฉลี่ย': ('รายได้รวม','mean'), 'ทุนเฉลี่ย': ('ทุนจดทะเบียน','mean'), 'กำไรเฉลี่ย': ('กำไรสุทธิ','mean')})
+    agg['by_grade'] = group_summary(df, 'เกรด', **{'จำนวน': ('บริษัท','count'), 'รายได้เฉลี่ย': ('รายได้รวม','mean'), 'รายได้รวม': ('รายได้รวม','sum'), 'ทุนเฉลี่ย': ('ทุนจดทะเบียน','mean')}).iloc[::-1].reset_index(drop=True) if has_grade else None
+    era = pd.cut(df['ปีจดทะเบียน'], bins=ERA_BINS, labels=ERA_LABELS).rename('ยุค')
+    agg['by_era'] = group_summary(df.loc[era.notna()], era[era.notna()], **{'จำนวน': ('บริษัท','count'), 'รายได้เฉลี่ย': ('รายได้รวม','mean'), 'ทุนเฉลี่ย': ('ทุนจดทะเบียน','mean')})
+    return agg
+
+@tracked('aggregates', st.cache_data(max_entries=2))
+def get_aggregates(version, _df):
+    """ผลสรุปที่ใช้ร่วมกันทุกหน้า memoize ตามเวอร์ชันข้อมูล (เก็บไว้ไม่เกิน 2 เวอร์ชัน)"""
+    return compute_aggregates(_df)
+
+WEBGL_MIN_ROWS = int(os.environ.get("LUKKA_WEBGL_ROWS", "1000"))  # ตั้งแต่จำนวนนี้ใช้ WebGL แทน SVG
+BIN_MIN_ROWS = int(os.environ.get("LUKKA_BIN_ROWS", "20000"))    # ตั้งแต่จำนวนนี้รวมเป็น heatmap ฝั่ง server
+SCATTER_BINS = 60
+SCATTER_TOP_N = 200   # จุดที่ y สูงสุดที่ยังแสดงเป็นรายบริษัทในโหมด heatmap
+SPARSE_BIN_MAX = 2    # จุดในช่องที่มีไม่เกินจำนวนนี้ถือเป็น outlier แสดงเป็นรายบริษัท
+
+def adaptive_scatter(d, x, y, color, size, title, log=False):
+    """scatter ที่ปรับตามจำนวนจุด: น้อย → SVG, ปานกลาง → WebGL,
+    มาก → นับจุดเป็น heatmap 2 มิติฝั่ง server แล้ววาดเฉพาะ top-N และ outlier เป็นรายบริษัท"""
+    orders = {color: list(d[color].cat.categories[::-1])} if isinstance(d[color].dtype, pd.CategoricalDtype) else None
+    if len(d) < BIN_MIN_ROWS:
+        return px.scatter(d, x=x, y=y, color=color, hover_name='บริษัท', size=size, size_max=40, log_x=log, log_y=log, title=title,
+                          render_mode='webgl' if len(d) >= WEBGL_MIN_ROWS else 'svg', category_orders=orders)
+    d = d[d[x].notna() & d[y].notna()]
+    bx, by = (np.log10(d[x].to_numpy(dtype=float)), np.log10(d[y].to_numpy(dtype=float))) if log else (d[x].to_numpy(dtype=float), d[y].to_numpy(dtype=float))
+    counts, xe, ye = np.histogram2d(bx, by, bins=SCATTER_BINS)
+    ix = np.clip(np.searchsorted(xe, bx, side='right') - 1, 0, SCATTER_BINS - 1)
+    iy = np.clip(np.searchsorted(ye, by, side='right') - 1, 0, SCATTER_BINS - 1)
+    top = np.zeros(len(d), dtype=bool)
+    top[np.argsort(-by, kind='stable')[:SCATTER_TOP_N]] = True
+    picked = d[top | (counts[ix, iy] <= SPARSE_BIN_MAX)]
+    xc, yc = (xe[:-1] + xe[1:]) / 2, (ye[:-1] + ye[1:]) / 2
+    fig = go.Figure(go.Heatmap(x=10 ** xc if log else xc, y=10 ** yc if log else yc, z=np.where(counts.T > 0, counts.T, np.nan),
+                               colorscale='Blues', name='จำนวนบริษัท', showscale=False, hovertemplate='%{z:,.0f} บริษัท<extra></extra>'))
+    fig.add_traces(px.scatter(picked, x=x, y=y, color=color, hover_name='บริษัท', size=size, size_max=20, render_mode='webgl', category_orders=orders).data)
+    fig.update_layout(title=f"{title} — {len(d):,} จุด (แสดงรายบริษัทเฉพาะ top {SCATTER_TOP_N} และ outlier)", legend_title_text=color)
+    fig.update_xaxes(title_text=x, type='log' if log else None)
+    fig.update_yaxes(title_text=y, type='log' if log else None)
+    return fig
+
+@tracked('capital_revenue_figure', st.cache_data(max_entries=2))
+def capital_revenue_figure(version, _df):
+    # FIX: fillna ก่อนใช้ size เพื่อป้องกัน NaN error
+    d = pd.DataFrame({'บริษัท': _df['บริษัท'], 'ประเภท': _df['ประเภท'], 'ทุนจดทะเบียน': _df['ทุนจดทะเบียน'].fillna(1),
+                      'รายได้รวม': _df['รายได้รวม'], 'รายได้รวม_plot': _df['รายได้รวม'].fillna(1)})
+    d = d[(d['ทุนจดทะเบียน'] > 0) & (d['รายได้รวม_plot'] > 0)]
+    return adaptive_scatter(d, 'ทุนจดทะเบียน', 'รายได้รวม', 'ประเภท', 'รายได้รวม_plot', 'ทุน vs รายได้ (log scale)', log=True)
+
+@tracked('score_revenue_figure', st.cache_data(max_entries=2))
+def score_revenue_figure(version, _df):
+    # FIX: fillna สำหรับ scatter size
+    keep = _df['รวมคะแนน'].notna() & _df['รายได้รวม'].notna()
+    d = pd.DataFrame({'บริษัท': _df['บริษัท'], 'เกรด': _df['เกรด'], 'รวมคะแนน': _df['รวมคะแนน'], 'รายได้รวม': _df['รายได้รวม'],
+                      'ทุน_plot': _df['ทุนจดทะเบียน'].fillna(1).clip(lower=1)})[keep]
+    return adaptive_scatter(d, 'รวมคะแนน', 'รายได้รวม', 'เกรด', 'ทุน_plot', 'คะแนน vs รายได้')
+
+EXPORT_CHUNK_ROWS = 10000
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def page_rows(frame, sort_col, desc, start, stop):
+    """แถวของหน้าที่ต้องแสดง — เรียงเฉพาะคอลัมน์ที่เลือกแล้วตัดช่วง ไม่เรียง/คัดลอกทั้งตาราง"""
+    if sort_col is None:
+        return frame.iloc[start:stop]
+    order = frame[sort_col].reset_index(drop=True).sort_values(ascending=not desc, na_position='last', kind='stable').index
+    return frame.iloc[order[start:stop]]
+
+def export_file(frame, fmt):
+    """สร้างไฟล์ export เป็น bytes ทีละ EXPORT_CHUNK_ROWS แถว (ถูกเรียกเมื่อกดดาวน์โหลดเท่านั้น)
+    ไฟล์ทั้งก้อนอยู่ในหน่วยความจำ เพราะ download_button รับเฉพาะ bytes/str/BytesIO และเก็บทั้งก้อนไว้ใน media store อยู่แล้ว"""
+    out = io.BytesIO()
+    starts = range(0, max(len(frame), 1), EXPORT_CHUNK_ROWS)
+    if fmt == 'xlsx':
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet('result')
+        ws.append(list(frame.columns))
+        for start in starts:
+            for row in frame.iloc[start:start + EXPORT_CHUNK_ROWS].itertuples(index=False):
+                ws.append([None if pd.isna(v) else v for v in row])
+        wb.save(out)
+    else:
+        for start in starts:
+            chunk = frame.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(index=False, header=start == 0)
+            out.write(chunk.encode('utf-8-sig' if start == 0 else 'utf-8'))
+    return out.getvalue()
+
+def export_buttons(frame, name, label="ดาวน์โหลด"):
+    """ปุ่มดาวน์โหลด CSV/XLSX ที่สร้างไฟล์เมื่อกดเท่านั้น"""
+    c1, c2 = st.columns(2)
+    c1.download_button(f"⬇️ {label} CSV", lambda: export_file(frame, 'csv'), f"{name}.csv", "text/csv", use_container_width=True)
+    c2.download_button(f"⬇️ {label} Excel", lambda: export_file(frame, 'xlsx'), f"{name}.xlsx", XLSX_MIME, use_container_width=True)
+
+CHAT_MODEL = 'gemini-1.5-flash'
+CHAT_ROWS = 15            # จำนวนแถวบริษัทที่ดึงมาประกอบคำถาม
+ANSWER_CACHE_SIZE = 256
+CHAT_COLS = ['บริษัท','ประเภท','ปีจดทะเบียน','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน','เกรด']
+
+class AnswerCache:
+    """LRU ของคำตอบ AI ตาม (เวอร์ชันข้อมูล, คำถาม) ใช้ร่วมกันทุก session"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+@st.cache_resource
+def answer_cache():
+    return AnswerCache(ANSWER_CACHE_SIZE)
+
+@st.cache_resource(max_entries=4)
+def gemini_client(api_key):
+    """Gemini client ต่อ API key ใช้ซ้ำข้าม rerun — key ผูกกับ client ตั้งแต่สร้าง
+    ไม่ใช้ genai.configure เพราะเป็น client กลางของทั้ง process (session อื่นที่ใส่ key ต่างกันจะทับกัน)"""
+    return glm.GenerativeServiceClient(client_options={'api_key': api_key})
+
+@tracked('chat_context', st.cache_data(max_entries=2))
+def chat_context(version, _df):
+    """ข้อความสรุปข้อมูลสำหรับ prompt สร้างครั้งเดียวต่อเวอร์ชันข้อมูล"""
+    agg = get_aggregates(version, _df)
+    return f"""คุณคือ AI วิเคราะห์ข้อมูลลูกค้าบริษัทรับเหมาก่อสร้าง ตอบภาษาไทยเสมอ กระชับ ชัดเจน มีประโยชน์
+ข้อมูลสรุป {agg['count']} ราย:
+- ประเภทบริษัท: {dict(agg['type_counts'].values)}
+- เกรด: {dict(agg['grade_counts'].values) if agg['grade_counts'] is not None else 'ไม่มีข้อมูล'}
+- รายได้รวมทั้งหมด: {agg['revenue_sum']:,.0f} ล้านบาท
+- รายได้เฉลี่ย: {agg['revenue_mean']:,.1f} ล้านบาท
+- ทุนจดทะเบียนเฉลี่ย: {agg['capital_mean']:,.1f} ล้านบาท
+- ปีก่อตั้งเฉลี่ย: พ.ศ. {agg['year_mean']:.0f}
+Top 5 รายได้สูงสุด:
+{agg['top5'].to_string(index=False)}"""
+
+def retrieve_rows(idx, df, question, limit=CHAT_ROWS):
+    """เลือกแถวบริษัทที่เกี่ยวกับคำถาม: บริษัทที่ถูกเอ่ยชื่อ แล้วเติมด้วยรายได้สูงสุดในเกรด/ประเภทที่ถามถึง"""
+    rows = list(idx.mentioned(question, limit=limit))
+    grades = [g for g in idx.bitmaps.get('เกรด', {}) if re.search(rf'(?<![\w+]){re.escape(str(g))}(?![\w+])', question)]
+    types = [t for t in idx.bitmaps.get('ประเภท', {}) if str(t).rstrip('.') in question and t != 'อื่นๆ']
+    if (grades or types) and len(rows) < limit:
+        pos = np.flatnonzero(idx.filter_mask(types, grades))
+        revenue = np.nan_to_num(df['รายได้รวม'].to_numpy(dtype=float)[pos], nan=-np.inf)
+        rows += [p for p in pos[np.argsort(-revenue, kind='stable')] if p not in rows][:limit - len(rows)]
+    if not rows:
+        return ''
+    cols = [c for c in CHAT_COLS if c in df.columns]
+    return f"\nข้อมูลบริษัทที่เกี่ยวข้องกับคำถาม:\n{df.iloc[rows][cols].to_string(index=False)}"
+
+def ask_model(client, prompt):
+    """ส่งคำถามแบบ streaming คืน generator ของข้อความทีละส่วน"""
+    request = glm.GenerateContentRequest(model=f"models/{CHAT_MODEL}", contents=[glm.Content(role='user', parts=[glm.Part(text=prompt)])])
+    with span('gemini_request'):
+        t0 = time.perf_counter()
+        for i, chunk in enumerate(client.stream_generate_content(request)):
+            if i == 0 and METRICS_ENABLED:
+                metrics().observe('gemini_first_token', time.perf_counter() - t0)
+            text = ''.join(part.text for cand in chunk.candidates[:1] for part in cand.content.parts)
+            if text:
+                yield text
+
 try:
-    df = load_data()
+    df, meta = dataset_store().get()
     data_ok = True
 except Exception as e:
     data_ok = False
     err_msg = str(e)
 
 with st.sidebar:
-    st.title("🏗️ ระบบลูกค้า 68")
+    st.title(f"🏗️ ระบบลูกค้า {CURRENT_YEAR}")
     st.divider()
-    page = st.radio("📌 เมนู", ["📊 Dashboard","🔍 ค้นหา","📋 สรุปกลุ่ม","🏛️ ค้นหา DBD","💬 AI Chat"])
+    page = st.radio("📌 เมนู", ["📊 Dashboard","🔍 ค้นหา","📋 สรุปกลุ่ม"] + (["📈 เทียบรายปี"] if len(SHEET_SOURCES) > 1 else []) + ["🏛️ ค้นหา DBD","💬 AI Chat"] + (["🛠️ Ops"] if st.query_params.get("ops") == "1" else []))
     st.divider()
     gemini_key = st.text_input("🔑 Gemini API Key", type="password", help="รับฟรีที่ aistudio.google.com")
     if gemini_key: st.success("✅ ใส่ Key แล้ว")
@@ -88,8 +893,16 @@ with st.sidebar:
     st.divider()
     if data_ok:
         st.success(f"✅ ข้อมูล {len(df)} ราย")
+        if meta.get('fetched_at'):
+            st.caption(f"ข้อมูล ณ {time.strftime('%d/%m/%Y %H:%M', time.localtime(meta['fetched_at']))}")
+        if meta.get('error'):
+            st.warning("⚠️ ดึงข้อมูลล่าสุดไม่ได้ กำลังใช้ข้อมูลสำรอง")
+        if len(SHEET_SOURCES) > 1:
+            years = dataset_store().years
+            st.caption("ปีที่โหลด: " + ", ".join(f"{y} ({len(years[y][0]):,})" + (" ⚠️" if years[y][1].get('error') else "") if y in years else f"{y} (ไม่มีข้อมูล)" for y in SHEET_SOURCES))
         if st.button("🔄 รีเฟรชข้อมูล"):
-            st.cache_data.clear()
+            with st.spinner("กำลังตรวจข้อมูลจากต้นทาง..."):
+                dataset_store().refresh()
             st.rerun()
     else:
         st.error("❌ โหลดข้อมูลไม่ได้")
@@ -98,240 +911,288 @@ if not data_ok:
     st.error(f"ไม่สามารถโหลดข้อมูล: {err_msg}")
     st.stop()
 
-# ========================== DASHBOARD ==========================
-if page == "📊 Dashboard":
-    st.title("📊 Dashboard ภาพรวมลูกค้า")
-    st.caption(f"ข้อมูลจาก Google Sheet | {len(df):,} บริษัท")
-    c1,c2,c3,c4 = st.columns(4)
-    c1.metric("🏢 ลูกค้าทั้งหมด", f"{len(df):,} ราย")
-    c2.metric("💰 รายได้รวม", f"{df['รายได้รวม'].sum():,.0f} ล้าน")
-    c3.metric("📈 รายได้เฉลี่ย", f"{df['รายได้รวม'].mean():,.1f} ล้าน")
-    c4.metric("🏆 เกรด A++", f"{len(df[df['เกรด']=='A++']) if 'เกรด' in df.columns else '-'} ราย")
-    st.divider()
-    ca,cb = st.columns(2)
-    with ca:
-        tc = df['ประเภท'].value_counts().reset_index()
-        tc.columns=['ประเภท','จำนวน']
-        st.plotly_chart(px.pie(tc,values='จำนวน',names='ประเภท',title='🏢 สัดส่วนประเภทบริษัท',hole=0.4,color_discrete_sequence=px.colors.qualitative.Set3), use_container_width=True)
-    with cb:
-        if 'เกรด' in df.columns:
-            gc = df['เกรด'].value_counts().reset_index()
-            gc.columns=['เกรด','จำนวน']
-            fig = px.bar(gc,x='เกรด',y='จำนวน',title='🏆 จำนวนตามเกรด',color='จำนวน',color_continuous_scale='Blues',text='จำนวน')
-            fig.update_traces(texttemplate='%{text}',textposition='outside')
-            st.plotly_chart(fig, use_container_width=True)
-    cc,cd = st.columns(2)
-    with cc:
-        top10 = df.nlargest(10,'รายได้รวม')[['บริษัท','รายได้รวม']].copy()
-        top10['บริษัท'] = top10['บริษัท'].str[:22]
-        fig = px.bar(top10,x='รายได้รวม',y='บริษัท',orientation='h',title='🥇 Top 10 รายได้สูงสุด (ล้านบาท)',color='รายได้รวม',color_continuous_scale='Greens',text='รายได้รวม')
-        fig.update_traces(texttemplate='%{text:,.0f}',textposition='outside')
-        fig.update_layout(yaxis={'categoryorder':'total ascending'},height=400)
-        st.plotly_chart(fig, use_container_width=True)
-    with cd:
-        yc = df.groupby('ปีจดทะเบียน').size().reset_index(name='จำนวน').dropna()
-        st.plotly_chart(px.area(yc,x='ปีจดทะเบียน',y='จำนวน',title='📅 บริษัทที่จดทะเบียนแต่ละปี',color_discrete_sequence=['#667eea']), use_container_width=True)
-    st.subheader("💡 ความสัมพันธ์ ทุนจดทะเบียน vs รายได้รวม")
-    # FIX: fillna ก่อนใช้ size เพื่อป้องกัน NaN error
-    df_plot = df.copy()
-    df_plot['ทุนจดทะเบียน'] = df_plot['ทุนจดทะเบียน'].fillna(1)
-    df_plot['รายได้รวม_plot'] = df_plot['รายได้รวม'].fillna(1)
-    df_plot = df_plot[df_plot['ทุนจดทะเบียน'] > 0]
-    df_plot = df_plot[df_plot['รายได้รวม_plot'] > 0]
-    st.plotly_chart(px.scatter(df_plot,x='ทุนจดทะเบียน',y='รายได้รวม',color='ประเภท',hover_name='บริษัท',size='รายได้รวม_plot',size_max=40,log_x=True,log_y=True,title='ทุน vs รายได้ (log scale)'), use_container_width=True)
-
-# ========================== ค้นหา ==========================
-elif page == "🔍 ค้นหา":
-    st.title("🔍 ค้นหาลูกค้า")
-    c1,c2,c3 = st.columns([2,1,1])
-    search = c1.text_input("🔎 ค้นหาชื่อบริษัท",placeholder="พิมพ์ชื่อบริษัท...")
-    tf = c2.multiselect("ประเภท", df['ประเภท'].unique(), default=list(df['ประเภท'].unique()))
-    gf = c3.multiselect("เกรด", df['เกรด'].dropna().unique().tolist() if 'เกรด' in df.columns else [])
-    c4,c5 = st.columns(2)
-    min_r = c4.number_input("รายได้ขั้นต่ำ (ล้านบาท)", 0.0, value=0.0, step=10.0)
-    min_c = c5.number_input("ทุนจดทะเบียนขั้นต่ำ (ล้านบาท)", 0.0, value=0.0, step=10.0)
-    filt = df.copy()
-    if search: filt = filt[filt['บริษัท'].str.contains(search,na=False,case=False)]
-    if tf: filt = filt[filt['ประเภท'].isin(tf)]
-    if gf: filt = filt[filt['เกรด'].isin(gf)]
-    if min_r > 0: filt = filt[filt['รายได้รวม'] >= min_r]
-    if min_c > 0: filt = filt[filt['ทุนจดทะเบียน'] >= min_c]
-    st.markdown(f"### พบ **{len(filt)}** รายการ")
-    dcols = [c for c in ['ลำดับ','ประเภท','บริษัท','ปีจดทะเบียน','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน','เกรด'] if c in filt.columns]
-    st.dataframe(filt[dcols].reset_index(drop=True), use_container_width=True, height=450)
-    st.download_button("⬇️ ดาวน์โหลดผลการค้นหา CSV", filt[dcols].to_csv(index=False,encoding='utf-8-sig'), "result.csv", "text/csv")
-
-# ========================== สรุปกลุ่ม ==========================
-elif page == "📋 สรุปกลุ่ม":
-    st.title("📋 สรุปตามกลุ่ม")
-    t1,t2,t3,t4 = st.tabs(["🏢 แยกประเภท","🏆 แยกเกรด","📅 แยกยุค","🔬 เปรียบเทียบ"])
-    with t1:
-        s = df.groupby('ประเภท').agg(จำนวน=('บริษัท','count'),รายได้รวม=('รายได้รวม','sum'),รายได้เฉลี่ย=('รายได้รวม','mean'),ทุนเฉลี่ย=('ทุนจดทะเบียน','mean'),กำไรเฉลี่ย=('กำไรสุทธิ','mean')).round(1).reset_index()
-        st.dataframe(s,use_container_width=True)
-        fig = px.bar(s,x='ประเภท',y='รายได้รวม',title='รายได้รวมแยกตามประเภท',color='ประเภท',text='รายได้รวม')
-        fig.update_traces(texttemplate='%{text:,.0f}',textposition='outside')
-        st.plotly_chart(fig,use_container_width=True)
-    with t2:
-        if 'เกรด' in df.columns:
-            gs = df.groupby('เกรด').agg(จำนวน=('บริษัท','count'),รายได้เฉลี่ย=('รายได้รวม','mean'),รายได้รวม=('รายได้รวม','sum'),ทุนเฉลี่ย=('ทุนจดทะเบียน','mean')).round(1).reset_index()
-            st.dataframe(gs,use_container_width=True)
-            if 'รวมคะแนน' in df.columns:
-                # FIX: fillna สำหรับ scatter size
-                df_s2 = df.dropna(subset=['รวมคะแนน','รายได้รวม']).copy()
-                df_s2['ทุน_plot'] = df_s2['ทุนจดทะเบียน'].fillna(1).clip(lower=1)
-                st.plotly_chart(px.scatter(df_s2,x='รวมคะแนน',y='รายได้รวม',color='เกรด',hover_name='บริษัท',title='คะแนน vs รายได้',size='ทุน_plot',size_max=40),use_container_width=True)
-    with t3:
-        de = df.dropna(subset=['ปีจดทะเบียน']).copy()
-        de['ยุค'] = pd.cut(de['ปีจดทะเบียน'],bins=[2499,2519,2539,2559,2570],labels=['ก่อน 2520','2520-2539','2540-2559','2560+'])
-        es = de.groupby('ยุค',observed=True).agg(จำนวน=('บริษัท','count'),รายได้เฉลี่ย=('รายได้รวม','mean'),ทุนเฉลี่ย=('ทุนจดทะเบียน','mean')).round(1).reset_index()
-        st.dataframe(es,use_container_width=True)
-        ca2,cb2 = st.columns(2)
-        with ca2: st.plotly_chart(px.pie(es,values='จำนวน',names='ยุค',title='สัดส่วนตามยุค',hole=0.3),use_container_width=True)
-        with cb2: st.plotly_chart(px.bar(es,x='ยุค',y='รายได้เฉลี่ย',title='รายได้เฉลี่ยตามยุค',color='ยุค',text='รายได้เฉลี่ย'),use_container_width=True)
-    with t4:
-        st.subheader("เปรียบเทียบบริษัท (สูงสุด 5 บริษัท)")
-        sel = st.multiselect("เลือกบริษัท",df['บริษัท'].tolist(),max_selections=5)
-        if sel:
-            cdf = df[df['บริษัท'].isin(sel)]
-            mets = [m for m in ['ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน'] if m in cdf.columns]
-            fig = go.Figure()
-            for _,row in cdf.iterrows():
-                fig.add_trace(go.Bar(name=row['บริษัท'][:15],x=mets,y=[row.get(m,0) for m in mets]))
-            fig.update_layout(barmode='group',title='เปรียบเทียบข้อมูล')
-            st.plotly_chart(fig,use_container_width=True)
-            st.dataframe(cdf[['บริษัท','ประเภท']+mets].reset_index(drop=True),use_container_width=True)
-        else:
-            st.info("เลือกบริษัทที่ต้องการเปรียบเทียบด้านบน")
-
-# ========================== ค้นหา DBD ==========================
-elif page == "🏛️ ค้นหา DBD":
-    st.title("🏛️ ค้นหาข้อมูลบริษัทจาก DBD")
-    st.markdown("""
-    ค้นหาข้อมูล **ทุนจดทะเบียน, ปีจดทะเบียน, ประเภทบริษัท, สถานะ** จากกรมพัฒนาธุรกิจการค้า (DBD)
-    """)
-    st.divider()
+page_t0 = time.perf_counter()
+# จับเวลาใน finally เพื่อให้นับหน้าที่จบด้วย st.stop()/st.rerun() ด้วย
+try:
+    # ========================== DASHBOARD ==========================
+    if page == "📊 Dashboard":
+        st.title("📊 Dashboard ภาพรวมลูกค้า")
+        agg = get_aggregates(meta['version'], df)
+        st.caption(f"ข้อมูลจาก Google Sheet | {agg['count']:,} บริษัท")
+        c1,c2,c3,c4 = st.columns(4)
+        c1.metric("🏢 ลูกค้าทั้งหมด", f"{agg['count']:,} ราย")
+        c2.metric("💰 รายได้รวม", f"{agg['revenue_sum']:,.0f} ล้าน")
+        c3.metric("📈 รายได้เฉลี่ย", f"{agg['revenue_mean']:,.1f} ล้าน")
+        c4.metric("🏆 เกรด A++", f"{agg['a_plus_plus'] if agg['a_plus_plus'] is not None else '-'} ราย")
+        st.divider()
+        ca,cb = st.columns(2)
+        with ca:
+            tc = agg['type_counts']
+            with span('chart:type_pie'):
+                st.plotly_chart(px.pie(tc,values='จำนวน',names='ประเภท',title='🏢 สัดส่วนประเภทบริษัท',hole=0.4,color_discrete_sequence=px.colors.qualitative.Set3), use_container_width=True)
+        with cb:
+            if agg['grade_counts'] is not None:
+                gc = agg['grade_counts']
+                with span('chart:grade_bar'):
+                    fig = px.bar(gc,x='เกรด',y='จำนวน',title='🏆 จำนวนตามเกรด',color='จำนวน',color_continuous_scale='Blues',text='จำนวน',category_orders={'เกรด': gc['เกรด'].tolist()})
+                    fig.update_traces(texttemplate='%{text}',textposition='outside')
+                    st.plotly_chart(fig, use_container_width=True)
+        cc,cd = st.columns(2)
+        with cc:
+            top10 = agg['top10']
+            with span('chart:top10_bar'):
+                fig = px.bar(top10,x='รายได้รวม',y='บริษัท',orientation='h',title='🥇 Top 10 รายได้สูงสุด (ล้านบาท)',color='รายได้รวม',color_continuous_scale='Greens',text='รายได้รวม')
+                fig.update_traces(texttemplate='%{text:,.0f}',textposition='outside')
+                fig.update_layout(yaxis={'categoryorder':'total ascending'},height=400)
+                st.plotly_chart(fig, use_container_width=True)
+        with cd:
+            yc = agg['year_counts']
+            with span('chart:year_area'):
+                st.plotly_chart(px.area(yc,x='ปีจดทะเบียน',y='จำนวน',title='📅 บริษัทที่จดทะเบียนแต่ละปี',color_discrete_sequence=['#667eea']), use_container_width=True)
+        st.subheader("💡 ความสัมพันธ์ ทุนจดทะเบียน vs รายได้รวม")
+        with span('chart:capital_revenue'):
+            st.plotly_chart(capital_revenue_figure(meta['version'], df), use_container_width=True)
 
-    company_input = st.text_input("🔎 พิมพ์ชื่อบริษัทที่ต้องการค้นหา", placeholder="เช่น ซิโน-ไทย, กาญจนสิงขร, CPRAM")
+    # ========================== ค้นหา ==========================
+    elif page == "🔍 ค้นหา":
+        st.title("🔍 ค้นหาลูกค้า")
+        c1,c2,c3 = st.columns([2,1,1])
+        search = c1.text_input("🔎 ค้นหาชื่อบริษัท",placeholder="พิมพ์ชื่อบริษัท...")
+        fuzzy = c1.toggle("ค้นหาแบบใกล้เคียง (ทนคำพิมพ์ผิด)", value=True)
+        tf = c2.multiselect("ประเภท", list(df['ประเภท'].cat.categories), default=list(df['ประเภท'].cat.categories))
+        gf = c3.multiselect("เกรด", list(df['เกรด'].cat.categories[::-1]) if 'เกรด' in df.columns else [])
+        c4,c5 = st.columns(2)
+        min_r = c4.number_input("รายได้ขั้นต่ำ (ล้านบาท)", 0.0, value=0.0, step=10.0)
+        min_c = c5.number_input("ทุนจดทะเบียนขั้นต่ำ (ล้านบาท)", 0.0, value=0.0, step=10.0)
+        idx = get_search_index(meta['version'], df)
+        with span('search_query'):
+            filt = df.iloc[idx.search(search, idx.filter_mask(tf, gf, min_r, min_c), fuzzy=fuzzy)]
+        st.markdown(f"### พบ **{len(filt)}** รายการ")
+        dcols = [c for c in ['ลำดับ','ประเภท','บริษัท','ปีจดทะเบียน','ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน','เกรด'] if c in filt.columns]
+        p1,p2,p3,p4 = st.columns([2,1,1,1])
+        sort_col = p1.selectbox("เรียงตาม", [None] + dcols, format_func=lambda c: 'ความเกี่ยวข้อง' if c is None else c)
+        desc = p2.toggle("มากไปน้อย", value=True, disabled=sort_col is None)
+        page_size = p3.selectbox("แถวต่อหน้า", [25, 50, 100, 250], index=1)
+        n_pages = max(1, math.ceil(len(filt) / page_size))
+        page_no = p4.number_input(f"หน้า (จาก {n_pages:,})", 1, n_pages, 1)
+        start = (page_no - 1) * page_size
+        st.dataframe(page_rows(filt[dcols], sort_col, desc, start, start + page_size).reset_index(drop=True), use_container_width=True, height=450)
+        st.caption(f"แสดงแถวที่ {min(start + 1, len(filt)):,}–{min(start + page_size, len(filt)):,} จาก {len(filt):,}")
+        export_buttons(filt[dcols], "result", "ดาวน์โหลดผลการค้นหา")
 
-    if company_input:
-        col1, col2 = st.columns([1,1])
-        with col1:
-            search_btn = st.button("🔍 ค้นหาใน DBD", type="primary", use_container_width=True)
-        with col2:
-            dbd_link = get_dbd_link(company_input)
-            st.link_button("🌐 เปิดหน้า DBD โดยตรง", dbd_link, use_container_width=True)
-
-        if search_btn:
-            with st.spinner(f"กำลังค้นหา '{company_input}' ใน DBD..."):
-                result = search_dbd(company_input)
-
-            if result:
-                st.success("✅ พบข้อมูล")
-                # แสดงผล raw JSON สำหรับ debug
-                if isinstance(result, dict):
-                    items = result.get('data', result.get('result', result.get('items', [])))
-                elif isinstance(result, list):
-                    items = result
-                else:
-                    items = []
-
-                if items:
-                    rows = []
-                    for item in items[:10]:
-                        row = {
-                            'ชื่อบริษัท': item.get('juristicName', item.get('name', item.get('companyName', ''))),
-                            'เลขทะเบียน': item.get('juristicId', item.get('registrationNumber', item.get('id', ''))),
-                            'ประเภท': item.get('juristicType', item.get('type', '')),
-                            'ทุนจดทะเบียน': item.get('registerCapital', item.get('capital', '')),
-                            'วันจดทะเบียน': item.get('registerDate', item.get('registrationDate', '')),
-                            'สถานะ': item.get('statusCode', item.get('status', '')),
-                        }
-                        rows.append(row)
-                    result_df = pd.DataFrame(rows)
-                    st.dataframe(result_df, use_container_width=True)
-
-                    # บันทึกลง session state เพื่อเลือกบันทึก
-                    if 'dbd_results' not in st.session_state:
-                        st.session_state.dbd_results = []
-                    st.session_state.dbd_results = rows
-
-                    st.subheader("💾 บันทึกข้อมูลลง Google Sheet")
-                    st.info("ฟีเจอร์นี้กำลังพัฒนา — ขณะนี้สามารถ Export ข้อมูลเป็น CSV ได้")
-                    st.download_button(
-                        "⬇️ ดาวน์โหลดข้อมูล DBD (CSV)",
-                        pd.DataFrame(rows).to_csv(index=False, encoding='utf-8-sig'),
-                        f"dbd_{company_input}.csv",
-                        "text/csv"
-                    )
-                else:
-                    st.warning("ไม่พบข้อมูลที่ตรงกัน ลองกด 'เปิดหน้า DBD โดยตรง' แล้วค้นหาด้วยตนเอง")
-                    with st.expander("🔍 Raw API Response (Debug)"):
-                        st.json(result)
+    # ========================== สรุปกลุ่ม ==========================
+    elif page == "📋 สรุปกลุ่ม":
+        st.title("📋 สรุปตามกลุ่ม")
+        agg = get_aggregates(meta['version'], df)
+        t1,t2,t3,t4 = st.tabs(["🏢 แยกประเภท","🏆 แยกเกรด","📅 แยกยุค","🔬 เปรียบเทียบ"])
+        with t1:
+            s = agg['by_type']
+            st.dataframe(s,use_container_width=True)
+            with span('chart:type_revenue_bar'):
+                fig = px.bar(s,x='ประเภท',y='รายได้รวม',title='รายได้รวมแยกตามประเภท',color='ประเภท',text='รายได้รวม')
+                fig.update_traces(texttemplate='%{text:,.0f}',textposition='outside')
+                st.plotly_chart(fig,use_container_width=True)
+        with t2:
+            if agg['by_grade'] is not None:
+                gs = agg['by_grade']
+                st.dataframe(gs,use_container_width=True)
+                if 'รวมคะแนน' in df.columns:
+                    with span('chart:score_revenue'):
+                        st.plotly_chart(score_revenue_figure(meta['version'], df),use_container_width=True)
+        with t3:
+            es = agg['by_era']
+            st.dataframe(es,use_container_width=True)
+            ca2,cb2 = st.columns(2)
+            with ca2, span('chart:era_pie'): st.plotly_chart(px.pie(es,values='จำนวน',names='ยุค',title='สัดส่วนตามยุค',hole=0.3),use_container_width=True)
+            with cb2, span('chart:era_bar'): st.plotly_chart(px.bar(es,x='ยุค',y='รายได้เฉลี่ย',title='รายได้เฉลี่ยตามยุค',color='ยุค',text='รายได้เฉลี่ย'),use_container_width=True)
+        with t4:
+            st.subheader("เปรียบเทียบบริษัท (สูงสุด 5 บริษัท)")
+            sel = st.multiselect("เลือกบริษัท",df['บริษัท'].tolist(),max_selections=5)
+            if sel:
+                cdf = df[df['บริษัท'].isin(sel)]
+                mets = [m for m in ['ทุนจดทะเบียน','รายได้รวม','กำไรสุทธิ','รวมคะแนน'] if m in cdf.columns]
+                with span('chart:compare_bar'):
+                    fig = go.Figure()
+                    for _,row in cdf.iterrows():
+                        fig.add_trace(go.Bar(name=row['บริษัท'][:15],x=mets,y=[row.get(m,0) for m in mets]))
+                    fig.update_layout(barmode='group',title='เปรียบเทียบข้อมูล')
+                    st.plotly_chart(fig,use_container_width=True)
+                st.dataframe(cdf[['บริษัท','ประเภท']+mets].reset_index(drop=True),use_container_width=True)
             else:
-                st.warning("⚠️ ไม่สามารถเชื่อมต่อ DBD API ได้โดยตรง")
-                st.markdown(f"""
-**วิธีแก้ไข:** กดลิงก์ด้านบนเพื่อค้นหาใน DBD โดยตรง หรือลองค้นหาด้วยชื่อย่อ
+                st.info("เลือกบริษัทที่ต้องการเปรียบเทียบด้านบน")
 
-🔗 [คลิกค้นหา '{company_input}' ใน DBD Datawarehouse]({dbd_link})
-                """)
+    # ========================== เทียบรายปี ==========================
+    elif page == "📈 เทียบรายปี":
+        st.title("📈 เทียบรายปี")
+        history = dataset_store().history
+        if not history:
+            st.info("ต้องมีข้อมูลอย่างน้อย 2 ปีจึงเทียบได้")
+            st.stop()
+        prev, cur = st.selectbox("เลือกคู่ปี", list(history)[::-1], format_func=lambda p: f"{p[0]} → {p[1]}")
+        yoy = history[(prev, cur)]
+        status = yoy['สถานะ'].value_counts()
+        kept = yoy[yoy['สถานะ'] == 'ต่อเนื่อง']
+        c1,c2,c3,c4 = st.columns(4)
+        c1.metric("🔁 ลูกค้าต่อเนื่อง", f"{status.get('ต่อเนื่อง', 0):,} ราย")
+        c2.metric("🆕 ลูกค้าใหม่", f"{status.get('ลูกค้าใหม่', 0):,} ราย")
+        c3.metric("👋 หายไป", f"{status.get('หายไป', 0):,} ราย")
+        c4.metric("💰 รายได้รวม (ต่อเนื่อง)", f"{kept[f'รายได้รวม {cur}'].sum():,.0f} ล้าน", f"{kept['รายได้เปลี่ยน'].sum():+,.0f} ล้าน")
+        t1,t2,t3,t4,t5 = st.tabs(["📈 เติบโตสูงสุด","📉 ลดลงมากสุด","🆕 ลูกค้าใหม่","👋 หายไป","🏆 เกรดเปลี่ยน"])
+        with t1: st.dataframe(kept.nlargest(50, 'รายได้เปลี่ยน'), use_container_width=True, hide_index=True)
+        with t2: st.dataframe(kept.nsmallest(50, 'รายได้เปลี่ยน'), use_container_width=True, hide_index=True)
+        with t3: st.dataframe(yoy[yoy['สถานะ'] == 'ลูกค้าใหม่'].sort_values(f'รายได้รวม {cur}', ascending=False), use_container_width=True, hide_index=True)
+        with t4: st.dataframe(yoy[yoy['สถานะ'] == 'หายไป'].sort_values(f'รายได้รวม {prev}', ascending=False), use_container_width=True, hide_index=True)
+        with t5:
+            moved = yoy[yoy['เกรดเปลี่ยน'].isin(['ขึ้น','ลง'])]
+            st.caption(f"เกรดขึ้น {(moved['เกรดเปลี่ยน'] == 'ขึ้น').sum():,} ราย | เกรดลง {(moved['เกรดเปลี่ยน'] == 'ลง').sum():,} ราย")
+            st.dataframe(moved, use_container_width=True, hide_index=True)
+        export_buttons(yoy, f"yoy_{prev}_{cur}", "ดาวน์โหลดผลเทียบรายปี")
 
-    st.divider()
-    st.subheader("📋 บริษัทในฐานข้อมูลที่ยังไม่มีข้อมูล DBD")
-    missing = df[df['ทุนจดทะเบียน'].isna() | (df['ทุนจดทะเบียน'] == 0)][['บริษัท','ประเภท','เกรด']].head(20)
-    if len(missing) > 0:
-        st.caption(f"พบ {len(df[df['ทุนจดทะเบียน'].isna() | (df['ทุนจดทะเบียน'] == 0)])} บริษัทที่ไม่มีข้อมูลทุนจดทะเบียน")
-        for _, row in missing.iterrows():
-            col1, col2 = st.columns([3,1])
+    # ========================== ค้นหา DBD ==========================
+    elif page == "🏛️ ค้นหา DBD":
+        st.title("🏛️ ค้นหาข้อมูลบริษัทจาก DBD")
+        st.markdown("""
+        ค้นหาข้อมูล **ทุนจดทะเบียน, ปีจดทะเบียน, ประเภทบริษัท, สถานะ** จากกรมพัฒนาธุรกิจการค้า (DBD)
+        """)
+        st.divider()
+
+        company_input = st.text_input("🔎 พิมพ์ชื่อบริษัทที่ต้องการค้นหา", placeholder="เช่น ซิโน-ไทย, กาญจนสิงขร, CPRAM")
+
+        if company_input:
+            col1, col2 = st.columns([1,1])
             with col1:
-                st.write(f"🏢 {row['บริษัท']} ({row['ประเภท']})")
+                search_btn = st.button("🔍 ค้นหาใน DBD", type="primary", use_container_width=True)
             with col2:
-                st.link_button("ค้นหา DBD", get_dbd_link(row['บริษัท']), use_container_width=True)
-    else:
-        st.success("✅ บริษัททุกรายมีข้อมูลทุนจดทะเบียนครบ")
-
-# ========================== AI CHAT ==========================
-elif page == "💬 AI Chat":
-    st.title("💬 ถามตอบ AI เกี่ยวกับข้อมูลลูกค้า")
-    if not gemini_key:
-        st.warning("⚠️ กรุณาใส่ Gemini API Key ในแถบซ้ายมือก่อน")
-        st.markdown("รับ Key ฟรีที่: https://aistudio.google.com/apikey")
-        st.stop()
-    try:
-        genai.configure(api_key=gemini_key)
-        model = genai.GenerativeModel('gemini-1.5-flash')
-    except Exception as e:
-        st.error(f"API Key ไม่ถูกต้อง: {e}")
-        st.stop()
-    gcol = 'เกรด' if 'เกรด' in df.columns else 'ประเภท'
-    top5 = df.nlargest(5,'รายได้รวม')[['บริษัท','รายได้รวม',gcol]].to_string(index=False)
-    ctx = f"""คุณคือ AI วิเคราะห์ข้อมูลลูกค้าบริษัทรับเหมาก่อสร้าง ตอบภาษาไทยเสมอ กระชับ ชัดเจน มีประโยชน์
-ข้อมูลสรุป {len(df)} ราย:
-- ประเภทบริษัท: {df['ประเภท'].value_counts().to_dict()}
-- เกรด: {df['เกรด'].value_counts().to_dict() if 'เกรด' in df.columns else 'ไม่มีข้อมูล'}
-- รายได้รวมทั้งหมด: {df['รายได้รวม'].sum():,.0f} ล้านบาท
-- รายได้เฉลี่ย: {df['รายได้รวม'].mean():,.1f} ล้านบาท
-- ทุนจดทะเบียนเฉลี่ย: {df['ทุนจดทะเบียน'].mean():,.1f} ล้านบาท
-- ปีก่อตั้งเฉลี่ย: พ.ศ. {df['ปีจดทะเบียน'].mean():.0f}
-Top 5 รายได้สูงสุด:
-{top5}"""
-    if "msgs" not in st.session_state:
-        st.session_state.msgs = [{"role":"assistant","content":f"สวัสดีครับ! ผมวิเคราะห์ข้อมูลลูกค้า **{len(df)} ราย** ถามได้เลยครับ เช่น\n- บริษัทไหนรายได้สูงสุด?\n- สรุปลูกค้าเกรด A++\n- บริษัทที่ก่อตั้งนานที่สุด?\n- เปรียบเทียบ บจก. กับ หจก."}]
-    for m in st.session_state.msgs:
-        with st.chat_message(m["role"]): st.markdown(m["content"])
-    if q := st.chat_input("ถามเกี่ยวกับข้อมูลลูกค้า..."):
-        st.session_state.msgs.append({"role":"user","content":q})
-        with st.chat_message("user"): st.markdown(q)
-        with st.chat_message("assistant"):
-            with st.spinner("กำลังวิเคราะห์..."):
-                try:
-                    r = model.generate_content(ctx + f"\n\nคำถาม: {q}")
-                    ans = r.text
+                dbd_link = get_dbd_link(company_input)
+                st.link_button("🌐 เปิดหน้า DBD โดยตรง", dbd_link, use_container_width=True)
+
+            if search_btn:
+                with st.spinner(f"กำลังค้นหา '{company_input}' ใน DBD..."):
+                    result = search_dbd(company_input)
+
+                if result:
+                    st.success("✅ พบข้อมูล")
+                    items = dbd_items(result)
+
+                    if items:
+                        rows = [dbd_row(item) for item in items[:10]]
+                        result_df = pd.DataFrame(rows)
+                        st.dataframe(result_df, use_container_width=True)
+
+                        # บันทึกลง session state เพื่อเลือกบันทึก
+                        if 'dbd_results' not in st.session_state:
+                            st.session_state.dbd_results = []
+                        st.session_state.dbd_results = rows
+
+                        st.subheader("💾 บันทึกข้อมูลลง Google Sheet")
+                        st.info("ฟีเจอร์นี้กำลังพัฒนา — ขณะนี้สามารถ Export ข้อมูลเป็น CSV หรือ Excel ได้")
+                        export_buttons(result_df, f"dbd_{company_input}", "ดาวน์โหลดข้อมูล DBD")
+                    else:
+                        st.warning("ไม่พบข้อมูลที่ตรงกัน ลองกด 'เปิดหน้า DBD โดยตรง' แล้วค้นหาด้วยตนเอง")
+                        with st.expander("🔍 Raw API Response (Debug)"):
+                            st.json(result)
+                else:
+                    st.warning("⚠️ ไม่สามารถเชื่อมต่อ DBD API ได้โดยตรง")
+                    st.markdown(f"""
+    **วิธีแก้ไข:** กดลิงก์ด้านบนเพื่อค้นหาใน DBD โดยตรง หรือลองค้นหาด้วยชื่อย่อ
+
+    🔗 [คลิกค้นหา '{company_input}' ใน DBD Datawarehouse]({dbd_link})
+                    """)
+
+        st.divider()
+        st.subheader("📋 บริษัทในฐานข้อมูลที่ยังไม่มีข้อมูล DBD")
+        if 'dbd_job' in st.session_state:
+            st.success(st.session_state.pop('dbd_job'))
+        missing = df[df['ทุนจดทะเบียน'].isna() | (df['ทุนจดทะเบียน'] == 0)]
+        if len(missing) > 0:
+            st.caption(f"พบ {len(missing)} บริษัทที่ไม่มีข้อมูลทุนจดทะเบียน")
+            if st.button(f"⚡ ดึงข้อมูล DBD ทั้ง {len(missing)} บริษัท", type="primary"):
+                bar = st.progress(0.0, text="กำลังค้นหาใน DBD...")
+                found = enrich_dbd(missing['บริษัท'].tolist(), progress=lambda done, total: bar.progress(done / total, text=f"ค้นหาใน DBD {done}/{total}"))
+                if len(found):
+                    save_enrichment(found)
+                    dataset_store().reload()
+                st.session_state.dbd_job = f"✅ เติมข้อมูลจาก DBD ได้ {len(found)} จาก {len(missing)} บริษัท"
+                st.rerun()
+            for _, row in missing[['บริษัท','ประเภท']].head(20).iterrows():
+                col1, col2 = st.columns([3,1])
+                with col1:
+                    st.write(f"🏢 {row['บริษัท']} ({row['ประเภท']})")
+                with col2:
+                    st.link_button("ค้นหา DBD", get_dbd_link(row['บริษัท']), use_container_width=True)
+        else:
+            st.success("✅ บริษัททุกรายมีข้อมูลทุนจดทะเบียนครบ")
+
+    # ========================== AI CHAT ==========================
+    elif page == "💬 AI Chat":
+        st.title("💬 ถามตอบ AI เกี่ยวกับข้อมูลลูกค้า")
+        if not gemini_key:
+            st.warning("⚠️ กรุณาใส่ Gemini API Key ในแถบซ้ายมือก่อน")
+            st.markdown("รับ Key ฟรีที่: https://aistudio.google.com/apikey")
+            st.stop()
+        try:
+            client = gemini_client(gemini_key)
+        except Exception as e:
+            st.error(f"API Key ไม่ถูกต้อง: {e}")
+            st.stop()
+        ctx = chat_context(meta['version'], df)
+        if "msgs" not in st.session_state:
+            st.session_state.msgs = [{"role":"assistant","content":f"สวัสดีครับ! ผมวิเคราะห์ข้อมูลลูกค้า **{len(df)} ราย** ถามได้เลยครับ เช่น\n- บริษัทไหนรายได้สูงสุด?\n- สรุปลูกค้าเกรด A++\n- บริษัทที่ก่อตั้งนานที่สุด?\n- เปรียบเทียบ บจก. กับ หจก."}]
+        for m in st.session_state.msgs:
+            with st.chat_message(m["role"]): st.markdown(m["content"])
+        if q := st.chat_input("ถามเกี่ยวกับข้อมูลลูกค้า..."):
+            st.session_state.msgs.append({"role":"user","content":q})
+            with st.chat_message("user"): st.markdown(q)
+            with st.chat_message("assistant"):
+                key = (meta['version'], q.strip())
+                ans = answer_cache().get(key)
+                count('cache_lookups', 'answers')
+                if ans is not None:
                     st.markdown(ans)
+                else:
+                    count('cache_misses', 'answers')
+                    try:
+                        related = retrieve_rows(get_search_index(meta['version'], df), df, q)
+                        ans = st.write_stream(ask_model(client, ctx + related + f"\n\nคำถาม: {q}"))
+                        answer_cache().put(key, ans)
+                    except Exception as e:
+                        st.error(f"เกิดข้อผิดพลาด: {e}")
+                if ans:
                     st.session_state.msgs.append({"role":"assistant","content":ans})
-                except Exception as e:
-                    st.error(f"เกิดข้อผิดพลาด: {e}")
-    col1,col2 = st.columns([1,4])
-    with col1:
-        if st.button("🗑️ ล้างประวัติ"):
-            st.session_state.msgs = []
-            st.rerun()
+        col1,col2 = st.columns([1,4])
+        with col1:
+            if st.button("🗑️ ล้างประวัติ"):
+                st.session_state.msgs = []
+                st.rerun()
+
+    # ========================== OPS (ซ่อน: เปิดด้วย ?ops=1) ==========================
+    elif page == "🛠️ Ops":
+        st.title("🛠️ Ops — ประสิทธิภาพระบบ")
+        if not METRICS_ENABLED:
+            st.warning("ปิดการเก็บ metrics อยู่ (LUKKA_METRICS=0)")
+        snap = metrics().snapshot()
+        st.caption(f"เก็บข้อมูลมา {snap['uptime'] / 60:,.0f} นาที")
+        c1, c2, c3 = st.columns(3)
+        c1.metric("🧮 ข้อมูลในหน่วยความจำ", f"{df.memory_usage(deep=True).sum() / 2**20:,.1f} MB")
+        if meta.get('memory_before'):
+            c2.metric("ก่อนย่อขนาด", f"{meta['memory_before'] / 2**20:,.1f} MB")
+            c3.metric("หลังย่อขนาด", f"{meta['memory_after'] / 2**20:,.1f} MB", f"{meta['memory_after'] / meta['memory_before'] - 1:.0%}", delta_color="inverse")
+        spans = pd.DataFrame([{'span': k, 'ครั้ง': v['count'], 'เฉลี่ย (ms)': v['mean'] * 1000, 'p50 (ms)': v['p50'] * 1000,
+                               'p95 (ms)': v['p95'] * 1000, 'สูงสุด (ms)': v['max'] * 1000} for k, v in sorted(snap['spans'].items())])
+        st.subheader("⏱️ เวลาต่อ span")
+        st.dataframe(spans.round(1), use_container_width=True)
+        c1, c2 = st.columns(2)
+        with c1:
+            st.subheader("🎯 Cache hit rate")
+            st.dataframe(pd.DataFrame(list(snap['cache_hit_rate'].items()), columns=['cache','hit rate']).round(3), use_container_width=True)
+        with c2:
+            st.subheader("❗ Error")
+            st.dataframe(pd.DataFrame([c for c in snap['counters'] if c['name'] == 'errors'], columns=['name','label','value']), use_container_width=True)
+        c1, c2 = st.columns(2)
+        c1.download_button("⬇️ Metrics (JSON)", lambda: json.dumps(metrics().snapshot(), ensure_ascii=False, indent=2), "metrics.json", "application/json", use_container_width=True)
+        c2.download_button("⬇️ Metrics (Prometheus)", lambda: metrics().prometheus(), "metrics.prom", "text/plain", use_container_width=True)
+        with st.expander("JSON"):
+            st.json(snap)
+finally:
+    if METRICS_ENABLED:
+        metrics().observe(f"page:{page}", time.perf_counter() - page_t0)
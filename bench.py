@@ -0,0 +1,345 @@
+"""benchmark ของ app.py: สร้างข้อมูลสังเคราะห์ตาม schema ของ Sheet แล้ววัด load_data() และทุกหน้าแบบ headless (AppTest)
+
+    python bench.py                                  # 1k / 100k / 1M แถว ผลเก็บที่ .cache/bench/
+    python bench.py --rows 1000,100000 --baseline .cache/bench/bench-20261016-120000.json
+
+แต่ละขนาดรันใน process แยก (cache ว่างทุกครั้ง) วัด wall time, หน่วยความจำสูงสุดต่อช่วง (tracemalloc, memory pool ของ Arrow และ RSS) และเวลา rerun
+Gemini ใช้โมเดลปลอม และ DBD ชี้ไปที่ HTTP server ในเครื่อง จึงไม่ยิงออกภายนอก
+ถ้าให้ --baseline จะเทียบทุกค่าและคืน exit code 1 เมื่อช้าลง/ใช้หน่วยความจำเกิน --tolerance
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from google.ai import generativelanguage as glm
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(ROOT, ".cache", "bench")
+DEFAULT_ROWS = [1_000, 100_000, 1_000_000]
+
+# ========================== ข้อมูลสังเคราะห์ ==========================
+SYLLABLES = ['ซิโน','ไทย','กาญจน','สิงขร','ช.การช่าง','อิตาเลียน','พร','สมบูรณ์','รุ่งเรือง','มั่นคง','ศรี','สยาม','วัฒนา','เจริญ','ทรัพย์',
+             'ชัย','กิจ','ธนา','พัฒน์','อุดม','เอก','นคร','ภัณฑ์','ยูนิค','แสง','ทอง','บูรพา','ลานนา','อีสาน','ทักษิณ','CPRAM','Build','Tech','Asia']
+BUSINESS = ['ก่อสร้าง','วิศวกรรม','คอนสตรัคชั่น','เอ็นจิเนียริ่ง','ดีเวลลอปเม้นท์','เทรดดิ้ง','การโยธา','ซัพพลาย','โฮลดิ้ง','อินดัสตรี']
+# (ค่าในคอลัมน์ธง, สัดส่วน) ตามลำดับคอลัมน์ บจก. / หจก. / บมจ. / JV — ที่เหลือไม่มีธง (อื่นๆ)
+TYPE_MIX = [('บจก.', .70), ('หจก.', .20), ('บมจ.', .05), ('JV', .03)]
+GRADE_BANDS = [(90,'A++'),(80,'A+'),(70,'A'),(65,'B+'),(60,'B'),(55,'C+'),(50,'C'),(40,'D')]
+HEADER = ['ลำดับ','บจก.','หจก.','บมจ.','JV','ชื่อบริษัท','ปีที่จดทะเบียน','ทุนจดทะเบียน (ล้านบาท)','รายได้รวม (ล้านบาท)','กำไรสุทธิ (ล้านบาท)',
+          'คะแนน 1','คะแนน 2','คะแนน 3','คะแนน 4','รวมคะแนน','เกรด']
+
+def synthetic_sheet(rows, seed=68):
+    """DataFrame ตามรูปแบบ Sheet จริง: ชื่อไทย, ธงประเภท 4 คอลัมน์, รายได้เบ้ขวา (Pareto), เกรดตามช่วงคะแนน, มีช่องว่างและแถวขยะท้ายตาราง"""
+    rng = np.random.default_rng(seed)
+    syl, biz = np.array(SYLLABLES, dtype=object), np.array(BUSINESS, dtype=object)
+    names = syl[rng.integers(len(syl), size=rows)] + syl[rng.integers(len(syl), size=rows)] + ' ' + biz[rng.integers(len(biz), size=rows)]
+    dup = rng.random(rows) < .5  # ให้ชื่อซ้ำน้อยลงเมื่อข้อมูลใหญ่ เหมือนชื่อจริงที่ยาวต่างกัน
+    names[dup] = names[dup] + ' ' + syl[rng.integers(len(syl), size=dup.sum())] + syl[rng.integers(len(syl), size=dup.sum())]
+    kind = rng.choice(len(TYPE_MIX) + 1, size=rows, p=[p for _, p in TYPE_MIX] + [1 - sum(p for _, p in TYPE_MIX)])
+    revenue = rng.pareto(1.16, rows) * 10 + 1
+    score = np.clip(rng.normal(68, 12, rows), 0, 100).round()
+    grade = np.full(rows, 'F', dtype=object)
+    for cut, g in GRADE_BANDS[::-1]:
+        grade[score >= cut] = g
+    blank = lambda p: rng.random(rows) < p
+    df = pd.DataFrame({
+        'ลำดับ': np.arange(1, rows + 1),
+        **{HEADER[1 + i]: np.where(kind == i, flag, '') for i, (flag, _) in enumerate(TYPE_MIX)},
+        'ชื่อบริษัท': names,
+        'ปีที่จดทะเบียน': np.where(blank(.03), np.nan, np.clip(2567 - rng.geometric(.05, rows), 2490, 2567)),
+        'ทุนจดทะเบียน (ล้านบาท)': np.where(blank(.05), np.nan, rng.lognormal(1.5, 1.4, rows).round(2)),
+        'รายได้รวม (ล้านบาท)': np.where(blank(.04), np.nan, revenue.round(2)),
+        'กำไรสุทธิ (ล้านบาท)': (revenue * rng.normal(.05, .08, rows)).round(2),
+        **{f'คะแนน {i}': rng.integers(0, 26, rows) for i in range(1, 5)},
+        'รวมคะแนน': score,
+        'เกรด': grade,
+    })
+    junk = pd.DataFrame({'ชื่อบริษัท': ['', 'nan', 'ชื่อบริษัท', 'รวม'] * max(1, rows // 2000)})
+    return pd.concat([df, junk], ignore_index=True)[HEADER]
+
+def write_sheet(rows, seed=68):
+    """เขียน CSV สังเคราะห์ (มีแถวชื่อตารางก่อนหัวคอลัมน์เหมือน export จาก Google Sheet) ใช้ไฟล์เดิมถ้ามีแล้ว"""
+    path = os.path.join(BENCH_DIR, "data", f"sheet_{rows}_{seed}.csv")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8', newline='') as f:
+            f.write('รายชื่อลูกค้า 68' + ',' * (len(HEADER) - 1) + '\n')
+            synthetic_sheet(rows, seed).to_csv(f, index=False)
+        os.replace(tmp, path)
+    return path
+
+# ========================== stub ภายนอก ==========================
+class FakeGemini:
+    """แทน glm.GenerativeServiceClient: ตอบแบบ stream ทันทีโดยไม่ยิง API"""
+    def __init__(self, client_options=None):
+        self.client_options = client_options
+
+    def stream_generate_content(self, request):
+        prompt = request.contents[0].parts[0].text
+        for text in ['คำตอบ ', 'ทดสอบ ', f'({len(prompt)} ตัวอักษร)']:
+            yield glm.GenerateContentResponse(candidates=[glm.Candidate(content=glm.Content(parts=[glm.Part(text=text)]))])
+
+class FakeDbd(BaseHTTPRequestHandler):
+    """DBD ปลอม: คืนบริษัทหนึ่งรายตามคำค้นทุกครั้ง"""
+    def do_GET(self):
+        keyword = self.path.partition('keyword=')[2].partition('&')[0]
+        body = json.dumps({'data': [{'juristicName': keyword, 'juristicId': '0105500000000', 'registerCapital': '5,000,000',
+                                     'registerDate': '2005-01-02', 'juristicType': 'บริษัทจำกัด', 'status': 'ยังดำเนินกิจการอยู่'}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_fake_dbd():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDbd)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+# ========================== วัดผล (process ลูก) ==========================
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return round(time.perf_counter() - t0, 4)
+
+def rss_bytes():
+    """RSS ปัจจุบันของ process (Linux: /proc/self/statm) — ru_maxrss ใช้ไม่ได้เพราะรีเซ็ตต่อช่วงไม่ได้"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+@contextlib.contextmanager
+def memory_peaks(out, interval=.002):
+    """วัดหน่วยความจำที่เพิ่มขึ้นสูงสุดระหว่างช่วงหนึ่ง ลงใน out เป็น 3 ค่า:
+    peak_mb (tracemalloc: object Python/NumPy), arrow_peak_mb (memory pool ของ Arrow ซึ่ง tracemalloc มองไม่เห็น —
+    คอลัมน์ string ของ pandas 3 และการอ่าน Parquet อยู่ที่นี่) และ rss_peak_mb (ทั้ง process รวม overhead ของ tracemalloc)
+    Arrow/RSS ไม่มี peak ที่รีเซ็ตได้ จึงใช้ thread เก็บตัวอย่างทุก interval วินาที ร่วมกับ max_memory() ของ pool เมื่อทะลุค่าเดิม"""
+    pool = pa.default_memory_pool()
+    base = {'rss': rss_bytes(), 'arrow': pool.bytes_allocated()}
+    base_max, peak, done = pool.max_memory(), dict(base), threading.Event()
+    def sample():
+        while True:
+            peak['rss'] = max(peak['rss'], rss_bytes())
+            peak['arrow'] = max(peak['arrow'], pool.bytes_allocated())
+            if done.wait(interval):
+                break
+    sampler = threading.Thread(target=sample, daemon=True)
+    tracemalloc.start()
+    sampler.start()
+    try:
+        yield out
+    finally:
+        done.set()
+        sampler.join()
+        out['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        tracemalloc.stop()
+        if pool.max_memory() > base_max:  # peak ใหม่ของทั้ง pool เกิดในช่วงนี้ — แม่นกว่าการสุ่มตัวอย่าง
+            peak['arrow'] = max(peak['arrow'], pool.max_memory())
+        out['arrow_peak_mb'] = round((peak['arrow'] - base['arrow']) / 2**20, 1)
+        out['rss_peak_mb'] = round((peak['rss'] - base['rss']) / 2**20, 1)
+
+def bench_load(app, data_path):
+    """load_data() จากไฟล์ในเครื่อง: cold (อ่าน CSV → แปลง → เขียน snapshot), warm (อ่าน Parquet), parse ซ้ำเมื่อไม่มีแถวเปลี่ยน"""
+    snapshot = [app.snapshot_path(app.CURRENT_YEAR, ext) for ext in ('parquet', 'json')]
+    def cold():
+        for p in snapshot:
+            if os.path.exists(p):
+                os.remove(p)
+        app.load_data()
+    with open(data_path, 'rb') as f:
+        raw = f.read()
+    with app.dataset_store().lock:  # กัน thread รีเฟรชของ app แทรกระหว่างวัด
+        out = {'cold_s': timed(cold), 'warm_s': timed(app.load_data)}
+        prev = pd.read_parquet(snapshot[0])
+        out['parse_full_s'] = timed(lambda: app.parse_sheet(raw))
+        out['parse_unchanged_s'] = timed(lambda: app.parse_sheet(raw, prev))
+        with memory_peaks(out):
+            cold()
+    out['rows'] = len(app.load_data()[0])
+    return out
+
+def widget(at, kind, label):
+    return next(w for w in getattr(at, kind) if w.label.startswith(label))
+
+def compare_companies(at):
+    """เลือก 3 บริษัทแรกในตัวเปรียบเทียบของหน้าสรุปกลุ่ม"""
+    ms = widget(at, 'multiselect', "เลือกบริษัท")
+    return ms.set_value(ms.options[:3])
+
+def dbd_search(at):
+    widget(at, 'text_input', "🔎 พิมพ์ชื่อบริษัท").set_value("ซิโน-ไทย").run()
+    return widget(at, 'button', "🔍 ค้นหาใน DBD").click()
+
+# (ชื่อ, เมนู, การกระทำหลังเปิดหน้า) — การกระทำคืน widget ที่ตั้งค่าแล้ว รอ .run()
+PAGES = [
+    ('dashboard', "📊 Dashboard", None),
+    ('search', "🔍 ค้นหา", lambda at: widget(at, 'text_input', "🔎 ค้นหาชื่อบริษัท").set_value("ซิโนไทย ก่อสราง")),
+    ('summary', "📋 สรุปกลุ่ม", compare_companies),
+    ('dbd', "🏛️ ค้นหา DBD", dbd_search),
+    ('chat', "💬 AI Chat", lambda at: at.chat_input[0].set_value("บริษัทไหนรายได้สูงสุด?")),
+]
+
+def new_session(timeout):
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    return AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=timeout)
+
+def check(at, name):
+    if at.exception:
+        raise RuntimeError(f"{name}: {at.exception[0].message}")
+    return at
+
+def bench_pages(reruns, timeout):
+    """เปิดแต่ละหน้าใน session เดียวกัน: render ครั้งแรก (cache ของหน้านั้นยังว่าง), rerun ซ้ำ และการกระทำหลักของหน้า
+    จากนั้นเปิด session ใหม่ที่ cache ว่างอีกรอบเพื่อวัดหน่วยความจำที่เพิ่มขึ้นต่อหน้า (memory_peaks) แยกจากเวลา
+    (สิ่งที่หน้าก่อนหน้า cache ค้างไว้นับเป็นฐาน ไม่นับซ้ำในหน้าถัดไป)"""
+    at = new_session(timeout)
+    out = {'startup_s': timed(lambda: check(at.run(), 'startup'))}
+    widget(at.sidebar, 'text_input', "🔑 Gemini API Key").set_value("bench").run()
+    pages = {}
+    for name, label, action in PAGES:
+        r = pages[name] = {'render_s': timed(lambda: check(at.sidebar.radio[0].set_value(label).run(), name))}
+        r['rerun_s'] = round(statistics.median(timed(lambda: check(at.run(), name)) for _ in range(reruns)), 4)
+        if action:
+            r['action_s'] = timed(lambda: check(action(at).run(), name))
+    at = new_session(timeout)
+    at.run()
+    widget(at.sidebar, 'text_input', "🔑 Gemini API Key").set_value("bench").run()
+    for name, label, action in PAGES:
+        with memory_peaks(pages[name]):
+            check(at.sidebar.radio[0].set_value(label).run(), name)
+            if action:
+                check(action(at).run(), name)
+    out['pages'] = pages
+    return out
+
+def worker(args):
+    """รันใน process ลูกที่ตั้ง env ไว้แล้ว: import app (รันหน้าแรกแบบ bare mode) แล้ววัด load และทุกหน้า"""
+    sys.path.insert(0, ROOT)
+    with mock.patch('google.ai.generativelanguage.GenerativeServiceClient', FakeGemini):
+        import app
+        result = {'load': bench_load(app, args.data)}
+        result.update(bench_pages(args.reruns, args.timeout))
+    result['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    with open(args.result, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False)
+
+def run_size(rows, args):
+    """วัดหนึ่งขนาดข้อมูลใน process ใหม่ที่มี cache dir ว่าง"""
+    data = write_sheet(rows, args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        result = os.path.join(tmp, 'result.json')
+        env = dict(os.environ, SHEET_URL=data, LUKKA_SHEETS='', LUKKA_CACHE_DIR=os.path.join(tmp, 'cache'), DBD_BASE=start_fake_dbd(),
+                   DBD_RATE='1000', LUKKA_REFRESH_SECONDS='86400', STREAMLIT_LOGGER_LEVEL='error')
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', '--data', data, '--result', result,
+               '--reruns', str(args.reruns), '--timeout', str(args.timeout)]
+        t0 = time.perf_counter()
+        proc = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.PIPE, text=True)
+        if proc.returncode:
+            raise SystemExit(f"benchmark {rows:,} แถวล้มเหลว:\n{(proc.stderr or '')[-3000:]}")
+        with open(result, encoding='utf-8') as f:
+            out = json.load(f)
+    out['total_s'] = round(time.perf_counter() - t0, 2)
+    return out
+
+# ========================== รายงาน / เทียบ baseline ==========================
+def flatten(d, prefix=''):
+    for k, v in d.items():
+        if isinstance(v, dict):
+            yield from flatten(v, f"{prefix}{k}.")
+        elif k.endswith(('_s', '_mb')):
+            yield prefix + k, v
+
+def compare(current, baseline, tolerance, min_delta):
+    """คืนรายการ (metric, baseline, ปัจจุบัน, อัตราส่วน, ถดถอยหรือไม่) ของ metric ที่มีทั้งสองฝั่ง"""
+    base = dict(flatten(baseline['results']))
+    rows = []
+    for key, now in flatten(current['results']):
+        if key in base:
+            # ฐานเป็น 0 ได้ (เช่นหน้าที่ไม่แตะ Arrow) — ถือว่าเพิ่มขึ้นไม่จำกัด แล้วตัดสินด้วย floor
+            ratio = now / base[key] if base[key] else (float('inf') if now else 1.0)
+            floor = min_delta if key.endswith('_s') else 1.0  # กันความผันผวนของค่าที่เล็กมาก
+            rows.append((key, base[key], now, ratio, ratio > 1 + tolerance and now - base[key] > floor))
+    return rows
+
+def mem(r):
+    return f"py {r['peak_mb']} / arrow {r['arrow_peak_mb']} / rss {r['rss_peak_mb']} MB"
+
+def report(current):
+    for rows, r in current['results'].items():
+        print(f"\n== {int(rows):,} แถว (ใช้เวลารวม {r['total_s']}s, RSS สูงสุด {r['max_rss_mb']} MB)")
+        load = r['load']
+        print(f"load_data  cold {load['cold_s']:.3f}s  warm {load['warm_s']:.3f}s  parse {load['parse_full_s']:.3f}s"
+              f" (ไม่เปลี่ยน {load['parse_unchanged_s']:.3f}s)  peak {mem(load)}")
+        print(f"startup    {r['startup_s']:.3f}s")
+        for name, p in r['pages'].items():
+            action = f"  action {p['action_s']:.3f}s" if 'action_s' in p else ''
+            print(f"{name:<10} render {p['render_s']:.3f}s  rerun {p['rerun_s']:.3f}s{action}  peak {mem(p)}")
+
+def main():
+    ap = argparse.ArgumentParser(description="benchmark app.py ด้วยข้อมูลสังเคราะห์")
+    ap.add_argument('--rows', default=','.join(map(str, DEFAULT_ROWS)), help="จำนวนแถว คั่นด้วย , (ค่าเริ่มต้น 1000,100000,1000000)")
+    ap.add_argument('--seed', type=int, default=68)
+    ap.add_argument('--reruns', type=int, default=3, help="จำนวน rerun ต่อหน้า (รายงานค่ามัธยฐาน)")
+    ap.add_argument('--timeout', type=float, default=600, help="timeout ต่อการรันหนึ่งครั้งของ AppTest (วินาที)")
+    ap.add_argument('--out', help="ไฟล์ JSON ผลลัพธ์ (ค่าเริ่มต้น .cache/bench/bench-<เวลา>.json)")
+    ap.add_argument('--baseline', help="ไฟล์ JSON ผลครั้งก่อนสำหรับเทียบ")
+    ap.add_argument('--tolerance', type=float, default=0.25, help="ยอมให้ช้าลง/ใหญ่ขึ้นได้เท่าไร (0.25 = 25%%)")
+    ap.add_argument('--min-delta', type=float, default=0.05, help="ไม่นับว่าถดถอยถ้าเวลาต่างกันน้อยกว่านี้ (วินาที)")
+    ap.add_argument('--verbose', action='store_true', help="แสดง log ของ process ลูก")
+    ap.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    ap.add_argument('--data', help=argparse.SUPPRESS)
+    ap.add_argument('--result', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.worker:
+        return worker(args)
+
+    current = {'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seed': args.seed,
+               'env': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                       'machine': platform.machine(), 'cpus': os.cpu_count()},
+               'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip(),
+               'results': {}}
+    for rows in (int(r) for r in args.rows.split(',')):
+        print(f"กำลังวัด {rows:,} แถว...", flush=True)
+        current['results'][str(rows)] = run_size(rows, args)
+    out = args.out or os.path.join(BENCH_DIR, f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    report(current)
+    print(f"\nบันทึกผลที่ {out}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows = compare(current, baseline, args.tolerance, args.min_delta)
+        print(f"\n== เทียบกับ {args.baseline} (commit {baseline.get('commit', '?')})")
+        for key, base, now, ratio, bad in rows:
+            print(f"{'❌' if bad else '  '} {key:<36} {base:>10} → {now:>10}  x{ratio:.2f}")
+        regressions = [r for r in rows if r[-1]]
+        if regressions:
+            print(f"\nช้าลง/ใช้หน่วยความจำเกิน {args.tolerance:.0%}: {len(regressions)} รายการ")
+            return 1
+        print("\nไม่มีค่าที่ถดถอยเกินเกณฑ์")
+
+if __name__ == '__main__':
+    sys.exit(main())
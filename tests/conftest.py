@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench import HEADER, synthetic_sheet  # noqa: E402
+
+# app.py อ่าน config จาก env ตอน import (และรันหน้าแรกแบบ bare mode) จึงต้องชี้ไปที่ไฟล์ในเครื่องก่อน import
+_tmp = tempfile.mkdtemp(prefix='lukka-test-')
+
+def sheet_bytes(frame):
+    """CSV แบบ export จาก Google Sheet: แถวชื่อตารางก่อนหัวคอลัมน์"""
+    return ('รายชื่อลูกค้า 68' + ',' * (len(HEADER) - 1) + '\n' + frame.to_csv(index=False)).encode('utf-8')
+
+with open(os.path.join(_tmp, 'sheet.csv'), 'wb') as f:
+    f.write(sheet_bytes(synthetic_sheet(200)))
+os.environ.update(SHEET_URL=os.path.join(_tmp, 'sheet.csv'), LUKKA_SHEETS='', LUKKA_CACHE_DIR=os.path.join(_tmp, 'cache'),
+                  LUKKA_REFRESH_SECONDS='86400', DBD_BASE='http://127.0.0.1:9')
+
+@pytest.fixture(scope='session')
+def app():
+    import app
+    return app
@@ -0,0 +1,27 @@
+from google.ai import generativelanguage as glm
+
+def response(*texts):
+    return glm.GenerateContentResponse(candidates=[glm.Candidate(content=glm.Content(parts=[glm.Part(text=t) for t in texts]))])
+
+class StubClient:
+    """แทน GenerativeServiceClient: จำ key ที่ใช้สร้างและคำขอที่ได้รับ ตอบเป็น stream ที่กำหนดไว้"""
+    def __init__(self, client_options=None):
+        self.api_key = client_options['api_key']
+        self.requests = []
+
+    def stream_generate_content(self, request):
+        self.requests.append(request)
+        return iter([response('รายได้', 'สูงสุด '), response(), response(f'ตอบด้วย {self.api_key}')])
+
+def test_gemini_client_is_created_per_key_and_reused(app, monkeypatch):
+    monkeypatch.setattr(app.glm, 'GenerativeServiceClient', StubClient)
+    a, b = app.gemini_client('stub-key-a'), app.gemini_client('stub-key-b')
+    assert (a.api_key, b.api_key) == ('stub-key-a', 'stub-key-b')
+    assert app.gemini_client('stub-key-a') is a
+
+def test_ask_model_streams_answer_from_the_sessions_client(app):
+    a, b = StubClient({'api_key': 'key-a'}), StubClient({'api_key': 'key-b'})
+    assert list(app.ask_model(a, 'บริษัทไหนรายได้สูงสุด?')) == ['รายได้สูงสุด ', 'ตอบด้วย key-a']
+    assert b.requests == []
+    request = a.requests[0]
+    assert request.model == f'models/{app.CHAT_MODEL}' and request.contents[0].parts[0].text == 'บริษัทไหนรายได้สูงสุด?'
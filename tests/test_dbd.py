@@ -0,0 +1,46 @@
+import time
+
+import pandas as pd
+import pytest
+
+from conftest import sheet_bytes, synthetic_sheet
+
+def item(name, capital, date):
+    return {'juristicName': name, 'registerCapital': capital, 'registerDate': date}
+
+def test_dbd_facts_uses_the_matching_company_not_the_first_hit(app):
+    result = {'data': [item('บริษัท ซิโน-ไทย เอ็นจีเนียริ่ง จำกัด', '900,000,000', '2005-01-02'),
+                       item('บริษัท ซิโน-ไทย จำกัด (มหาชน)', '5,000,000', '1999-01-02')]}
+    assert app.dbd_facts(result, 'ซิโน-ไทย') == {'ทุนจดทะเบียน': 5.0, 'ปีจดทะเบียน': 2542}
+    assert app.dbd_facts({'data': [item('บริษัท อื่น จำกัด', '1,000,000', '2001-01-01')]}, 'ซิโน-ไทย') is None
+
+def test_enrich_dbd_cancels_pending_lookups_when_interrupted(app, monkeypatch):
+    calls = []
+    def slow_search(name):
+        calls.append(name)
+        time.sleep(0.2)
+        return {'data': [item(name, '1,000,000', '2001-01-01')]}
+    def interrupt(done, total):
+        raise KeyboardInterrupt  # แทน RerunException ที่ Streamlit โยนเมื่อผู้ใช้กดอย่างอื่นระหว่างทำงาน
+    monkeypatch.setattr(app, 'search_dbd', slow_search)
+    t0 = time.perf_counter()
+    with pytest.raises(KeyboardInterrupt):
+        app.enrich_dbd([f'บริษัท {i}' for i in range(40)], progress=interrupt, workers=2)
+    assert time.perf_counter() - t0 < 1.0
+    time.sleep(0.5)
+    assert len(calls) <= 4
+
+def test_enrich_dbd_keeps_only_matching_results(app, monkeypatch):
+    monkeypatch.setattr(app, 'search_dbd', lambda name: {'data': [item(name if name.endswith('1') else 'บริษัท อื่น จำกัด', '2,000,000', '2010-05-05')]})
+    found = app.enrich_dbd(['บจก. หนึ่ง 1', 'สอง 2'], workers=2)
+    assert found.to_dict('records') == [{'บริษัท': 'บจก. หนึ่ง 1', 'ทุนจดทะเบียน': 2.0, 'ปีจดทะเบียน': 2553}]
+
+def test_load_data_survives_missing_snapshot_meta(app, monkeypatch, tmp_path):
+    # snapshot Parquet และผล DBD ยังอยู่ แต่ไฟล์ meta หายหรืออ่านไม่ได้ — ต้องโหลดได้ ไม่ใช่ทั้งแอปล่ม
+    monkeypatch.setattr(app, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(app, 'ENRICH_PATH', str(tmp_path / 'dbd_enriched.parquet'))
+    df, _ = app.parse_sheet(sheet_bytes(synthetic_sheet(50)))
+    df.to_parquet(app.snapshot_path('68', 'parquet'))
+    app.save_enrichment(pd.DataFrame({'บริษัท': [df['บริษัท'].iloc[0]], 'ทุนจดทะเบียน': [1.0], 'ปีจดทะเบียน': [2550]}))
+    loaded, meta = app.load_data('68')
+    assert len(loaded) == len(df) and meta['version']
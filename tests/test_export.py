@@ -0,0 +1,23 @@
+import io
+
+import openpyxl
+import pandas as pd
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+def sample(n):
+    return pd.DataFrame({'บริษัท': [f'บริษัท {i}' for i in range(n)], 'รายได้รวม': [i * 1.5 if i % 7 else None for i in range(n)]})
+
+def test_csv_export_round_trips_through_download_button(app, monkeypatch):
+    monkeypatch.setattr(app, 'EXPORT_CHUNK_ROWS', 100)
+    frame = sample(250)
+    data, _ = convert_data_to_bytes_and_infer_mime(app.export_file(frame, 'csv'), unsupported_error=TypeError('unsupported'))
+    assert data.startswith('﻿'.encode('utf-8'))
+    pd.testing.assert_frame_equal(pd.read_csv(io.BytesIO(data), encoding='utf-8-sig'), frame)
+
+def test_xlsx_export_round_trips_through_download_button(app, monkeypatch):
+    monkeypatch.setattr(app, 'EXPORT_CHUNK_ROWS', 100)
+    frame = sample(250)
+    data, _ = convert_data_to_bytes_and_infer_mime(app.export_file(frame, 'xlsx'), unsupported_error=TypeError('unsupported'))
+    rows = list(openpyxl.load_workbook(io.BytesIO(data), read_only=True)['result'].values)
+    assert list(rows[0]) == list(frame.columns) and len(rows) == 251
+    assert rows[8][:1] == ('บริษัท 7',) and rows[9] == ('บริษัท 8', 12.0)
@@ -0,0 +1,13 @@
+def test_snapshot_quantiles_match_the_copied_buckets(app, monkeypatch):
+    m = app.Metrics()
+    for _ in range(10):
+        m.observe('page', 0.004)
+    real_quantile = app.Metrics.quantile
+    def racing_quantile(h, q):
+        # span อื่นบันทึกเวลาช้าๆ เข้ามาระหว่างที่ snapshot คำนวณ percentile (นอก lock)
+        for _ in range(100):
+            m.observe('page', 20.0)
+        return real_quantile(h, q)
+    monkeypatch.setattr(app.Metrics, 'quantile', staticmethod(racing_quantile))
+    span = m.snapshot()['spans']['page']
+    assert span['count'] == 10 and span['p50'] == span['p95'] == 0.004